@@ -2,48 +2,63 @@
 # coding: utf-8
 
 import pandas as pd
-from serpapi import GoogleSearch
-import json
+import argparse
+import collector
+import runs
+import sweep
 
-GoogleSearch.SERP_API_KEY = "YOUR API KEY GOES HERE"
+SERP_API_KEY = "YOUR API KEY GOES HERE"
 
 
-def image_search(query, country):
+def list_searches(run, api_key):
     '''
-    Makes a Google Image Search using SerpApi.
-    The results are saved in JSON format.
-    
-    Params
-    
-    query: The terms to search for. String.
-    country: This is the name of the JSON file that will be saved.
+    Lists the searches of a run, such as "<adjective> women" for
+    every nationality, saved under the name of the country.
     '''
-    try:
-        search = GoogleSearch({"q": query.lower(), "tbm": "isch"})
-        results = search.get_json()
 
-        with open(f"../output/search_results/{country.replace(' ','-').lower()}.json", "w+") as f:
-            json.dump(results, f, indent=4)
-            
-    except Exception as e:
-        results = {"error": e}
-        
-        with open(f"../output/search_results/{country.replace(' ','-').lower()}.json", "w+") as f:
-            json.dump(results, f, indent=4)
+    nationalities = pd.read_csv(run["input"])
 
+    return [ {"q": run["template"].format(**row),
+              "params": dict(sweep.BASE_PARAMS, api_key=api_key),
+              "name": row["country"],
+              "root": run["root"]}
+             for row in nationalities.to_dict("records") ]
 
-def main():
 
-    nationalities = pd.read_csv("../input/nationalities.csv")
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Collect Google Image Search results with SerpAPI")
+    parser.add_argument("--api-key", default=SERP_API_KEY)
+    parser.add_argument("--endpoint", default=collector.ENDPOINT,
+                        help="SerpAPI search endpoint, or the one of fake_serpapi.py")
+    parser.add_argument("--concurrency", type=int, default=collector.CONCURRENCY,
+                        help="searches in flight at the same time")
+    parser.add_argument("--rate", type=float, default=collector.REQUESTS_PER_SECOND,
+                        help="searches started per second")
+    parser.add_argument("--pages", type=int, default=collector.PAGES,
+                        help="pages of about 100 results to collect for each search")
+    parser.add_argument("--sweep", help="JSON file describing a sweep of queries, locales and repetitions")
+    runs.add_arguments(parser)
 
-    search_queries = [ adjective + " women" for adjective in nationalities.adjectivals]
+    return parser.parse_args()
 
-    countries = [ country for country in nationalities.country ]
 
-    for query, country in zip(search_queries, countries):
-        image_search(query, country)
+def main():
+
+    args = parse_args()
 
+    if args.sweep:
+        spec = sweep.read_spec(args.sweep)
+        sweep.save_partitions(spec)
+        jobs = sweep.plan(spec, args.api_key)
+    else:
+        jobs = list_searches(runs.from_args(args), args.api_key)
 
+    collector.run(jobs,
+                  pages=args.pages,
+                  endpoint=args.endpoint,
+                  concurrency=args.concurrency,
+                  requests_per_second=args.rate)
 
 
 if __name__ == "__main__":
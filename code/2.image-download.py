@@ -6,114 +6,112 @@
 # Now we have image search information about around 200 nationalities. 
 # We also need to download the images in order to analyze them computationally.
 
-import requests
-from requests import ConnectionError
-from requests.exceptions import ReadTimeout
-from urllib3.exceptions import ReadTimeoutError
-import json
-import glob
+import argparse
 import os
-import shutil
-from pprint import pprint
-from multiprocessing import Pool, cpu_count
 
-# We need to read all the downloaded JSON files in order to access the image list. Let's define a function to do that.
-def glob_filepaths(pattern):
-    return glob.glob(pattern)
+import annotation
+import downloader
+import ledger
+import manifest
+import runlog
+import runs
+import search_results
 
 
-# Now, we will define a function that will read each one of those to retrieve the image URLs and download the content.
-def download_images(fpath):
+# Now, we will define a function that will list the image URLs that still need to be downloaded.
+def list_downloads(df, conn, root, ttl_days=manifest.TTL_DAYS):
     '''
-    Downloads the images listed in the JSON file
-    representing the search results retrieved by SerpAPI.
-    Saves the images of a given country inside a folder with the query name.
+    Lists the images in the search results retrieved by SerpAPI
+    that weren't downloaded yet. The images are saved in the
+    blob store and linked to their query in the download manifest.
+    Images that were already downloaded from the same URL, for
+    another query or another run, less than `ttl_days` days ago,
+    are linked without downloading them. Older ones are requested
+    again, only to be downloaded if they changed. The thumbnail
+    of each search result is kept in case the original fails.
     
     Params
     
-    fpath: the path to a .json file saved at the previous notebook
+    df: the table of search results returned by search_results.load()
+    conn: a connection to the download manifest
+    root: the output directory of the run
     '''
-    
-    def download_image(url, position):
-        '''
-        Helper function that downloads a single image from a URL using
-        the requests module.
-        
-        Params
-        
-        url: The url to an image file 
-        position: The position the image had in Google Image Search. Used as filename.
-        '''
-        
-        
-        print(f">> Fetching file #{position} at url {url}")
-        
-        # If the file for this position already exists, skip it
-        files = glob.glob(f"{directory}/{position}.*")
-        if len(files) > 0:
-            print(">> File already downloaded")
-            return
-
-        try:
-            r = requests.get(url, stream=True, timeout=10, headers={"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:15.0) Gecko/20100101 Firefox/15.0.1"})
-            if r.status_code == 200:
-
-                r.raw.decode_content = True
-
-                # Determines content type
-                try:
-                    content_type = r.headers["content-type"]
-                    extension = content_type.split("/")[1]
-                except (KeyError, IndexError):
-                    print(f"Can't guess file type  on url {url}, position #{position}")
-                    return
-
-                # Saves file
-                with open(f'{directory}/{position}.{extension}', 'wb') as out_file:
-                    shutil.copyfileobj(r.raw, out_file)
-
-            else:
-                print(f">> Status code error {r.status_code} on url {url}, position #{position}")
-                
-        except (ConnectionError, ReadTimeout, ReadTimeoutError):
-            print(f">> Connection error found in url {url}, position #{position}")
-            return
-        
-
-    print(f"Looking at fpath {fpath}")
-
-    # Redas data in
-    data = json.load(open(fpath, "r"))
-    
-    # Creates subdirectory
-    query = data["search_information"]["query_displayed"]
-    query = query.replace(" ","-")
-   
-    directory = f"../output/imgs/{query}" 
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    
-    # Fetch image URLs
-    image_results = data["images_results"]
 
-    urls = [item["original"] for item in image_results if "original" in item.keys()]
-    positions = [item["position"] for item in image_results]
+    known = manifest.queries(conn)
+    done = manifest.completed(conn)
+
+    # Images downloaded to per-query folders before the manifest existed are added to it once
+    for search_query in df.search_query.unique():
+        directory = f"{root}/imgs/{search_query.replace(' ', '-')}"
+        if search_query not in known and os.path.exists(directory):
+            positions = manifest.backfill(conn, search_query, directory)
+            done |= {(search_query, position) for position in positions}
     
-    # Download them
-    print(f"> Downloading files for query '{query}'")
-    for url, position in zip(urls, positions):
-        download_image(url, position)
+    # If the file for a position was already downloaded, skip it
+    df = df[~df.original.isna()]
+    pending = [ (search_query, position) not in done for search_query, position in zip(df.search_query, df.position) ]
+
+    jobs = [ {"search_query": row.search_query, "url": row.original, "position": row.position,
+              "thumbnail": row.thumbnail if isinstance(row.thumbnail, str) and row.thumbnail else None}
+             for row in df[pending].itertuples() ]
+
+    linked = manifest.reuse(conn, jobs, ttl_days)
+    print(f"> Linked {len(linked)} images that were already downloaded")
+
+    jobs = [ job for job in jobs if (job["search_query"], job["position"]) not in linked ]
+
+    # The validators of the images downloaded too long ago are sent with their requests
+    cached = manifest.lookup(conn, [job["url"] for job in jobs])
+    for job in jobs:
+        if job["url"] in cached:
+            job["cached"] = cached[job["url"]]
+
+    return jobs
+
+
+# Now, we can download every image of every query at once, sharing a single pool of connections.
+# With --annotate, each image is also sent to step 5's annotation backend as soon as it is stored,
+# instead of waiting for every download and for step 4. Step 5 then only annotates what is left.
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Downloads the images in the search results")
+    parser.add_argument("--ttl", type=float, default=manifest.TTL_DAYS,
+                        help="days an image downloaded for another query or run is reused without checking it")
+    parser.add_argument("--annotate", action="store_true",
+                        help="annotate the images while they are downloaded, with the options of step 5")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="only download the images that failed in earlier runs, as listed in the job ledger")
+    parser.add_argument("--deadline", type=float, default=downloader.DEADLINE,
+                        help="seconds an original image gets before falling back to its thumbnail")
+    annotation.add_arguments(parser)
+    runs.add_arguments(parser)
+
+    return parser.parse_args()
 
 
-# Now, we can run the commands in the main function using paralell processing to make things go a little faster.
 def main():
 
-    pool = Pool(cpu_count())
-    fpaths = glob_filepaths("../output/search_results/*.json")
-    pool.map(download_images, fpaths)
-    pool.close()
-    pool.join()
+    args = parse_args()
+    run = runs.from_args(args)
+
+    conn = manifest.connect(run["root"])
+    ledger_conn = ledger.connect(run["root"])
+
+    jobs = list_downloads(search_results.load(run["root"]), conn, run["root"], args.ttl)
+    jobs = ledger.track(ledger_conn, ledger.DOWNLOAD, jobs, args.retry_failed)
+
+    stream = None
+    if args.annotate:
+        stream = annotation.AnnotationStream(annotation.make_annotator(args), run["root"], ledger_conn,
+                                             args.images_per_minute, args.workers)
+
+    print(f"> Downloading {len(jobs)} files")
+    downloader.run(jobs, conn, ledger_conn, runlog.get(run["root"]), stream=stream, deadline=args.deadline)
+    conn.close()
+    ledger_conn.close()
+
+    if stream is not None:
+        print(f"> Annotated {stream.n_images} images while downloading")
 
 if __name__ == "__main__":
     main()
-
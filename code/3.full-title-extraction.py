@@ -2,103 +2,88 @@
 # coding: utf-8
 
 # Full title extraction
-from bs4 import BeautifulSoup
-import requests
-import json
-import glob
-import os
-from multiprocessing import Pool, cpu_count
+import argparse
 
-# First, we will need to access the JSON files.
-def glob_filepaths(pattern):
-    return glob.glob(pattern)
+import ledger
+import linkstore
+import runlog
+import runs
+import search_results
+import titles
 
 
-# Then, we will need to download the text files for each URL.
-def download_titles(fpath):
+# First, we will need to list the pages whose titles weren't downloaded yet.
+def list_titles(df, conn, root, ttl_days=linkstore.TTL_DAYS):
     '''
-    Downloads the text for each linked in the JSON file
-    representing the search results retrieved by SerpAPI.
-    Saves the texts of a given country inside a folder with the query name.
+    Lists the pages linked in the search results retrieved
+    by SerpAPI whose title wasn't fetched yet. The titles are
+    recorded in the link contents store of the run. Titles that
+    were already fetched from the same URL, by this run or any
+    other, less than `ttl_days` days ago, are copied instead.
+    Older ones are requested again, to see if they changed.
     
     Params
     
-    fpath: the path to a .json file saved at the previous notebook
+    df: the table of search results returned by search_results.load()
+    conn: a connection to the link contents store
+    root: the output directory of the run
     '''
-    
-    def download_full_title(url, position, directory):
-        '''
-        Helper function that downloads a single image from a URL using
-        the requests module.
-        
-        Params
-        
-        url: The url to a website
-        position: The position the image had in Google Image Search. Used as filename.
-        '''
-        
-        print(f">> Fetching full title #{position} at url {url}")
-        
-        # If the file already exists, skip
-        # pattern_a = f"{directory}/{position}-trafilatura.json"
-        pattern = f"{directory}/{position}-title-tag.json"
-        if os.path.exists(pattern):
-            print(">> File already downloaded")
-            return
-        
-
-        r = requests.get(url, timeout=10)
-
-        if r.ok:
-
-            soup = BeautifulSoup(r.text, "lxml")
-            title = soup.title.string
-
-            if title:
-                with open(f'{directory}/{position}-title-tag.json', 'w+') as f:
-                    json.dump({"title": title,
-                               "url": url}, f) 
-            else:
-                print(f">> No titlte tag in {url}")
-
-        else:
-            print(f">> Response not succesful in {url}")
-
-
-    # Redas data in
-    data = json.load(open(fpath, "r"))
-    
-    # Creates subdirectory
-    query = data["search_information"]["query_displayed"]
-    query = query.replace(" ","-")
-   
-    directory = f"../output/link_contents/{query}" 
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    
-    # Fetch URLs
-    image_results = data["images_results"]
-    urls = [item["link"] for item in image_results]
-    positions = [item["position"] for item in image_results]
-    
-    # Download them
-    print(f"> Downloading text for query '{query}'")
-    for url, position in zip(urls, positions):
-        try:
-            download_full_title(url, position, directory)
-        except Exception as e:
-            print(f"> Error {e} on position #{position}")
+
+    # Titles saved as one file per position before the store existed are added to it once
+    linkstore.backfill_queries(conn, df.search_query.unique(), root)
+    done = linkstore.completed(conn)
+
+    # If the title for a position was already fetched, skip it
+    df = df[~df.link.isna()]
+    pending = [ (search_query, position) not in done for search_query, position in zip(df.search_query, df.position) ]
+
+    jobs = [ {"search_query": row.search_query, "url": row.link, "position": row.position}
+             for row in df[pending].itertuples() ]
+
+    linked = linkstore.reuse(conn, jobs, ttl_days)
+    print(f"> Copied {len(linked)} titles that were already fetched")
+
+    jobs = [ job for job in jobs if (job["search_query"], job["position"]) not in linked ]
+
+    # The validators of the pages fetched too long ago are sent with their requests
+    cached = linkstore.lookup(conn, [job["url"] for job in jobs])
+    for job in jobs:
+        key = linkstore.url_key(job["url"])
+        if key in cached:
+            job["cached"] = cached[key]
+
+    return jobs
+
+
+# Let's run that for every page of every query at once.
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Fetches the titles of the pages in the search results")
+    parser.add_argument("--ttl", type=float, default=linkstore.TTL_DAYS,
+                        help="days a title fetched for another query or run can be reused")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="only fetch the titles that failed in earlier runs, as listed in the job ledger")
+    runs.add_arguments(parser)
+
+    return parser.parse_args()
 
 
-# Let's run that.
 def main():
 
-    pool = Pool(cpu_count())
-    fpaths = glob_filepaths("../output/search_results/*.json")
-    pool.map(download_titles, fpaths)
-    pool.close()
-    pool.join()
+    args = parse_args()
+    run = runs.from_args(args)
+
+    conn = linkstore.connect(run["root"])
+    ledger_conn = ledger.connect(run["root"])
+
+    jobs = list_titles(search_results.load(run["root"]), conn, run["root"], args.ttl)
+    jobs = ledger.track(ledger_conn, ledger.TITLE, jobs, args.retry_failed)
+
+    print(f"> Downloading {len(jobs)} titles")
+    titles.run(jobs, conn, ledger_conn, runlog.get(run["root"]))
+    conn.close()
+    ledger_conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
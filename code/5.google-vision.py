@@ -17,225 +17,199 @@
 
 
 import pandas as pd
-import requests
-from google.cloud import vision
-import io
+import argparse
 import json
 import os
-from pprint import pprint
-import multiprocessing
-import numpy as np
 import time
-from PIL import Image, UnidentifiedImageError
+from concurrent.futures import ThreadPoolExecutor
 
+import annotation
+import ledger
+import runlog
+import runs
+import vision_table
 
-# In[2]:
 
+# The requests to the API and the annotations stored by image hash are handled by annotation.py,
+# which 2.image-download.py also uses to annotate images while they are downloaded (--annotate).
 
-# Globals/credentials
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.abspath("../credentials/portrayal-of-women-cloud-vision-credentials.json")
+def seed_hash_results(df, root):
+    '''
+    Stores under their image hash the results that were saved
+    for a query and position before results were kept by hash,
+    so those images are not sent to the API again.
+    '''
+    
+    done = annotation.annotated()
+    
+    for row in df[~df.img_sha256.isin(done)].drop_duplicates(subset="img_sha256").itertuples():
+        
+        fpath = f"{root}/vision_results/{row.search_query.replace(' ', '-')}-{row.position}.json"
+        
+        try:
+            with open(fpath) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            continue
+            
+        annotation.save_json({key: data[key] for key in ["path", "label_annotations", "safe_search_annotations"]},
+                             row.img_sha256)
 
 
-def retrieve_image_annotations(path, search_query, position):
-    
+def make_batches(df):
     '''
-    Detects labels and safe search annotations
-    for a local image. Returns the results as
-    a dictionary.
+    Splits the images that were not analyzed yet into
+    batches of at most BATCH_SIZE images and MAX_BATCH_BYTES bytes.
     
     Params:
-    path: path to image file
-    search_query: the google image search string that retrieved this image
-    position: the position of the image in google search results
+    df: a dataframe with one row per unique image
     '''
     
-    def parse(r, path, search_query, position):
-        '''
-        Formats the Cloud Vision API response
-        in a JSON-like format.
-        '''
-
-        # Names of likelihood from google.cloud.vision.enums
-        likelihood_name = ('UNKNOWN', 'VERY_UNLIKELY', 'UNLIKELY', 'POSSIBLE',
-                           'LIKELY', 'VERY_LIKELY')
-
-
-        safe_search_annotations = {
-
-            "adult": { 
-                "likelihood": likelihood_name[r["safe_search"].adult],
-            },
-            "racy": {
-                "likelihood": likelihood_name[r["safe_search"].racy],
-            },
-            "spoof": {
-                "likelihood": likelihood_name[r["safe_search"].spoof],
-            },
-            "medical": {
-                "likelihood": likelihood_name[r["safe_search"].medical],
-            },
-            "violence": {
-                "likelihood": likelihood_name[r["safe_search"].violence],
-            },
-
-        }
-
-        label_annotations = [ ]
-
-        for label in r["labels"]:
-            label_annotations.append({
-                "mid": label.mid,
-                "score": float(label.score),
-                "topicality": float(label.topicality),
-                "description": label.description
-            })
-
-        return {
-            "path": path,
-            "search_query": search_query.replace(" ", "-"),
-            "position": int(position),
-            "label_annotations": label_annotations,
-            "safe_search_annotations": safe_search_annotations
-        }
-    
-    
-    def save_json(data, search_query, position):
-        '''
-        Saves the parsed response as JSON file.
-        '''
-        
-        directory = f"../output/vision_results/"
-        fname = f"{search_query.replace(' ', '-')}-{position}.json"    
-        fpath = f"{directory}{fname}"
-                
-        with open(fpath, "w+") as f:
-            json.dump(data, f, indent=4)
-    
-    
+    # Check if an image was already processed, under any query. If it was, skip it.
+    # This happens before any image file is opened.
+    done = annotation.annotated()
+    df = df[~df.img_sha256.isin(done)]
     
-    print(f"Now looking at image {path}")
+    batches = [ ]
+    batch, batch_bytes = [ ], 0
     
-    # Checks if file is an image. If not, raise error
-    try:
-        with Image.open(path) as im:
-            im.verify()
-    except UnidentifiedImageError:
-        # Saves error message to a log
-        logfile = f"../output/logs/error-{search_query.replace(' ', '-')}-{position}.txt"
-        log = "File is not an image"
+    for row in df.itertuples():
         
-        with open(logfile, "w+") as f:
-            f.write(log)
-            
-        raise TypeError(f"{search_query} position #{position}: file is not an image")
+        # The file size was recorded by the downloader
+        size = row.img_bytes
         
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
+        if batch and (len(batch) == annotation.BATCH_SIZE or batch_bytes + size > annotation.MAX_BATCH_BYTES):
+            batches.append(batch)
+            batch, batch_bytes = [ ], 0
+            
+        batch.append(row)
+        batch_bytes += size
         
-    # Check if this file was already processed. If it was, return nothing
-    if os.path.isfile( f"../output/vision_results/{search_query.replace(' ', '-')}-{position}.json"):
-        print(f"{search_query} position #{position} already analyzed")
-        return
+    if batch:
+        batches.append(batch)
         
-    # Sleeps to avoid surpassing API quotas
-    time.sleep(.3)
+    return batches
+
+
+def save_result(root, path, digest, search_query, position):
+    '''
+    Copies the annotations stored for an image hash into
+    the JSON file of a given query and position in the
+    output directory of the run.
+    '''
     
-    # Initializes API client
-    client = vision.ImageAnnotatorClient()
+    fpath = f"{root}/vision_results/{search_query.replace(' ', '-')}-{position}.json"
     
-    # Makes requests for label and safe search endpoints
-    image = vision.Image(content=content)
+    if os.path.isfile(fpath):
+        return
     
-    response = client.annotate_image({
-        "image": image,
-        "features": [{'type_': vision.Feature.Type.LABEL_DETECTION}, 
-                     {'type_': vision.Feature.Type.SAFE_SEARCH_DETECTION}]
-    })
+    try:
+        with open(f"{annotation.HASH_DIR}{digest}.json") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
     
-    # If there's an error with the rquest
-    if response.error.message:
-        logfile = f"../output/logs/error-{search_query.replace(' ', '-')}-{position}.txt"
-        # Saves error message to a log
-        log = f"Error '{response.error.message}' on file {path}"
-
-        with open(logfile, "w+") as f:
-            f.write(log)
-        
-        # Raise
-        raise RuntimeError("Error in Cloud Vision API request. Check log files for more information")
-        
-   
-    # Parses response
-    r = {
-        "labels": response.label_annotations,
-        "safe_search": response.safe_search_annotation
+    data = {
+        "path": path,
+        "search_query": search_query.replace(" ", "-"),
+        "position": int(position),
+        "label_annotations": data["label_annotations"],
+        "safe_search_annotations": data["safe_search_annotations"]
     }
     
-    r = parse(r, path, search_query, position)
-    
-    # Saves the parsed response as a JSON file
-    save_json(r, search_query, position)
-    
-    print(f"Sucessfully saved Cloud Vision data for query {search_query}, position #{position}")
+    with open(fpath, "w+") as f:
+        json.dump(data, f, indent=4)
 
 
-# In[22]:
+# In[23]:
 
 
-def analyze_images(df, axis=1):
+def analyze_images(batches, annotator, ledger_conn, log, images_per_minute=annotation.IMAGES_PER_MINUTE,
+                   n_workers=annotation.N_WORKERS):
     '''
-    A wrapper function that will apply
-    the function analyse_image to each 
-    row of the dataframe
+    Sends the batches to the annotator from n_workers threads,
+    paced by a token bucket shared by all of them, with as many
+    batches in flight as their adaptive limit allows.
     '''
     
-    def analyze_image(row):
-        '''
-        Performs the requests to the API using pandas
-        df.apply methods.
-        '''
+    bucket = annotation.make_bucket(images_per_minute)
+    limit = annotation.make_limit(n_workers)
+    
+    with ThreadPoolExecutor(n_workers) as executor:
+        list(executor.map(lambda batch: annotation.annotate_batch(batch, bucket, limit, annotator, ledger_conn, log), batches))
 
-        try:
-            retrieve_image_annotations(row.img_path, row.search_query, row.position)
-        except (TypeError, RuntimeError):
-            print(f"Error on row {row.name}, check logs for more information")
-            return
-                
+    limit.report()
 
-    df.apply(analyze_image, axis=axis)
 
-# In[23]:
+# In[24]:
 
 
-def parallelize(df, func):
+def parse_args():
     '''
-    Runs a apply function in parallel
-    by splitting the dy by as many
-    CPU cores as available.
+    Reads the command line options. By default the images are sent
+    to Cloud Vision; "--backend fake" uses the offline stand-in instead,
+    which is meant for timing and testing this step.
     '''
     
-    # Determines the number of 
-    n_cores = multiprocessing.cpu_count()
-    df_split = np.array_split(df, n_cores)
+    parser = argparse.ArgumentParser(description="Annotates the downloaded images")
+    annotation.add_arguments(parser)
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="only annotate the images that failed in earlier runs, as listed in the job ledger")
+    runs.add_arguments(parser)
     
-    pool = multiprocessing.Pool(n_cores)
-    pool.map(func, df_split)
-    pool.close()
-    pool.join()
-
-
-# In[24]:
+    return parser.parse_args()
 
 
 def main():
     
+    args = parse_args()
+    annotator = annotation.make_annotator(args)
+    root = runs.from_args(args)["root"]
+    
     # Reads the collected data
-    df = pd.read_csv("../output/dataset/aggregated-raw-data.csv")
+    df = pd.read_csv(f"{root}/dataset/aggregated-raw-data.csv")
     
     # Removes the images for which the download failed
     df = df[~df.img_path.isna()]
-        
-    parallelize(df, analyze_images)
+    
+    for directory in [annotation.HASH_DIR, f"{root}/vision_results", f"{root}/logs"]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    
+    seed_hash_results(df, root)
+    
+    ledger_conn = ledger.connect(root)
+    
+    # Each unique image is analyzed only once...
+    unique = df.drop_duplicates(subset="img_sha256")
+    
+    # ...and with --retry-failed, only if it failed before, under any query
+    if args.retry_failed:
+        failures = ledger.failed(ledger_conn, ledger.VISION)
+        failed_hashes = {digest for search_query, position, digest in zip(df.search_query, df.position, df.img_sha256)
+                         if (search_query, position) in failures}
+        unique = unique[unique.img_sha256.isin(failed_hashes)]
+    
+    batches = make_batches(unique)
+    ledger.add(ledger_conn, ledger.VISION, [(row.search_query, row.position) for batch in batches for row in batch])
+    
+    n_images = sum(len(batch) for batch in batches)
+    print(f"Analyzing {n_images} images in {len(batches)} batches")
+    
+    start = time.monotonic()
+    analyze_images(batches, annotator, ledger_conn, runlog.get(root), args.images_per_minute, args.workers)
+    ledger_conn.close()
+    elapsed = time.monotonic() - start
+    
+    print(f"Analyzed {n_images} images in {elapsed:.1f}s ({n_images / max(elapsed, 1e-9):.1f} images/s)")
+    
+    # ...and the results are copied to every query and position that returned it
+    for row in df.itertuples():
+        save_result(root, row.img_path, row.img_sha256, row.search_query, row.position)
+    
+    # They are also added to a single table, which is what the next step reads
+    table = vision_table.update_table(df, root)
+    print(f"Saved {len(table)} vision results to {vision_table.TABLE_PATH.format(root=root)}")
 
 
 # In[25]:
@@ -243,4 +217,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
@@ -2,51 +2,44 @@
 # coding: utf-8
 
 import pandas as pd
-import json
-from pprint import pprint
 import numpy as np
 import nltk
+import string
 
+import runs
+import vision_table
 
 
-def retrieve_safesearch_likelihood(row):
+
+def retrieve_safesearch_likelihood(df, root):
     '''
-    df.apply function that retrieves the Google Cloud Vision
-    data for a given search term.
+    Adds the Google Cloud Vision safe search likelihoods
+    to each row of the dataframe, joining it with the
+    table of vision results saved by the previous step
+    in the output directory of the run, `root`.
     '''
     
-    # Build the path to the file with the data Cloud Vision API data
-    search_query = row.search_query.replace(" ","-")
-    position = row.position
-        
-    fpath = f"../output/vision_results/{search_query}-{position}.json"
+    vision = vision_table.read_table(root)
+    vision = vision[["query_key", "position"] + vision_table.SAFE_SEARCH_CATEGORIES]
     
-    try:
-        # Access the JSON file
-        with open(fpath) as f:
-            data = json.load(f)
-            safe_search = data["safe_search_annotations"]
-    except FileNotFoundError:
-        return None
-        
-    results = {
-        "adult": safe_search["adult"]["likelihood"],
-        "racy": safe_search["racy"]["likelihood"],
-        "spoof": safe_search["spoof"]["likelihood"],
-        "violence": safe_search["violence"]["likelihood"],
-        "medical": safe_search["medical"]["likelihood"]
-    }
-        
-    return pd.Series(results)
+    # The vision results identify queries with dashes instead of spaces
+    df["query_key"] = df.search_query.str.replace(" ", "-")
+    
+    df = df.merge(vision, on=["query_key", "position"], how="left")
+    
+    return df.drop(columns="query_key")
 
 
-def retrieve_m49_standard(df):
+def retrieve_m49_standard(df, run):
     '''
     Adds ISO-code, M49 code and country name data to the dataframe.
+    The countries are matched with the search queries of the run,
+    as described in runs.py.
     '''
     
-    # Reads the nationalities, adjectivals and demonyms csv
-    nationalities = pd.read_csv("../input/nationalities.csv")
+    # Reads the nationalities csv of the run, such as the one with adjectivals and demonyms
+    nationalities = pd.read_csv(run["input"])
+    input_columns = list(nationalities.columns)
     
     # Reads and formats the CSV with the UN M49 standard classification
     m49 = pd.read_csv("../input/unsd-m49.tsv", sep='\t', dtype="str")
@@ -438,15 +431,25 @@ def retrieve_m49_standard(df):
          },
     ]
 
-    # Performs the replacement
+    # Performs the replacement. The fill values hold the columns of the English
+    # nationalities csv, so other columns of the input, like a search query in
+    # the local language, are taken from the row of the same country
     fill_values = pd.DataFrame(fill_values)
+    
+    missing = nationalities.loc[nationalities.m49_code.isna(),
+                                ["country"] + [c for c in input_columns if c not in fill_values.columns]]
+    fill_values = fill_values.merge(missing, on="country", how="left")
             
     nationalities = nationalities.dropna(subset=["m49_code"])
     
     nationalities = pd.concat([nationalities, fill_values]).reset_index()
+    
+    # Fill values of countries that the run didn't search for can't be turned into a query
+    fields = [field for _, field, _, _ in string.Formatter().parse(run["template"]) if field]
+    nationalities = nationalities.dropna(subset=fields)
         
     # Now we can select the  merged values and join them with the search result data
-    nationalities["search_query"] = nationalities.adjectivals.str.lower() + " women"
+    nationalities["search_query"] = [run["template"].format(**row).lower() for row in nationalities.to_dict("records")]
     
     df = df.merge(nationalities, on='search_query')
     
@@ -454,42 +457,38 @@ def retrieve_m49_standard(df):
 
 
 def add_counts(df):
-  '''
-  Adds the count of all images fetched succesfully
-  '''
+    '''
+    Adds, for each search query, the count of results, of images
+    and titles fetched succesfully, of images that are only the
+    thumbnail of the result and of images analyzed by Cloud Vision.
+    The counts are repeated on every row of the query.
+    '''
     
-    # Dict that will hold the count of images and results for each search query
-    imgs_fetched = {}
-    results_fetched = {}
+    # Non-null values in each column, counted once per query and broadcast back to its rows
+    grouped = df.groupby("search_query")
     
-    # For each unique query...
-    for search_query in df.search_query.unique():
-        
-        # Compute how many images were fetched and save it into the dictionary
-        img_count = df[(df.search_query == search_query) & ~(df.img_path.isna())].shape[0]
-        imgs_fetched[search_query] = img_count
-        
-        # Do the same for the results
-        results_count = df[(df.search_query == search_query)].shape[0]
-        results_fetched[search_query] = results_count
-
-    # Creates a new column by matching the search query column with the dictionaries above
-    df["imgs_fetched"] = df.search_query.map(imgs_fetched)
-    df["results_fetched"] = df.search_query.map(results_fetched)
-
+    df["imgs_fetched"] = grouped.img_path.transform("count")
+    df["thumbnails_fetched"] = (df.img_variant == "thumbnail").groupby(df.search_query).transform("sum")
+    df["results_fetched"] = grouped.search_query.transform("size")
+    df["titles_fetched"] = grouped.full_title.transform("count")
+    df["imgs_analyzed"] = grouped.racy.transform("count")
     
     return df
 
 
 def main():
     
-    df = pd.read_csv("../output/dataset/aggregated-raw-data.csv")
+    run = runs.parse_args("Joins the search results with the vision results and country data")
+    
+    df = pd.read_csv(f"{run['root']}/dataset/aggregated-raw-data.csv")
+    
+    df = retrieve_safesearch_likelihood(df, run["root"])
     
-    df = pd.concat([df, df.apply(retrieve_safesearch_likelihood, axis=1)], axis=1)
+    df = add_counts(df)
         
-    df = retrieve_m49_standard(df)
+    df = retrieve_m49_standard(df, run)
         
-    df.to_csv("../output/dataset/complete-data.csv", index=False)
+    df.to_csv(f"{run['root']}/dataset/complete-data.csv", index=False)
                   
     return df
 
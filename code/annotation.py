@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Annotation of downloaded images, shared by 5.google-vision.py and the
+# streaming mode of 2.image-download.py.
+#
+# Images are sent to one of the backends in annotators.py in batches, from a
+# pool of threads paced by a token bucket sized to the API quota. How many
+# batches are in flight adapts to the API (see ratelimit.py): it grows while
+# the requests stay fast and succeed, and it is cut when the API slows down,
+# fails or answers RESOURCE_EXHAUSTED. The annotations of each image are saved
+# under the hash of its content, so an image that was returned by several
+# queries, in any run, is only sent once. Requests that fail as a whole are
+# retried with backoff, and the outcome of every image is recorded in the job
+# ledger (see ledger.py) and the run log (see runlog.py).
+#
+# Step 5 annotates every image of a run once the dataset of step 4 exists.
+# AnnotationStream instead annotates images while they are being downloaded:
+# the downloader puts each image it stores into a bounded queue, and the
+# annotation workers take batches from it. When the workers fall behind, the
+# queue fills up and the downloads wait for them, so the images waiting to be
+# annotated never pile up.
+
+import asyncio
+import io
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from annotators import AnnotatorError, CloudVisionAnnotator, FakeAnnotator, QuotaError
+import ledger
+from ratelimit import AdaptiveLimit, TokenBucket
+import runlog
+import vision_table
+
+
+CREDENTIALS_PATH = "../credentials/portrayal-of-women-cloud-vision-credentials.json"
+
+HASH_DIR = vision_table.HASH_DIR
+
+# Images are sent in batches of up to 16, the maximum accepted by batch_annotate_images.
+# The whole request also has to stay below the API's 10 MB limit.
+BATCH_SIZE = 16
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+# Cloud Vision's default quota is 1,800 images per minute
+IMAGES_PER_MINUTE = 1800
+
+# Maximum number of batches in flight at the same time, and number to start with
+N_WORKERS = 16
+INITIAL_WORKERS = 4
+
+# Downloaded images waiting to be annotated, in streaming mode
+QUEUE_SIZE = 4 * BATCH_SIZE * N_WORKERS
+
+# An image downloaded and waiting to be annotated, with the same fields as the dataset
+Image = namedtuple("Image", ["search_query", "position", "img_path", "img_sha256", "img_bytes"])
+
+# Tells a streaming worker that no more images are coming
+DONE = object()
+
+
+def save_json(data, digest):
+    '''
+    Saves the parsed response as JSON file
+    named after the image hash.
+    '''
+
+    fpath = f"{HASH_DIR}{digest}.json"
+
+    with open(fpath, "w+") as f:
+        json.dump(data, f, indent=4)
+
+
+def read_image(path):
+    '''
+    Returns the content of an image file. The file was already
+    validated when it was downloaded, so it is not checked again.
+    '''
+
+    with io.open(path, 'rb') as image_file:
+        return image_file.read()
+
+
+def annotated():
+    '''
+    Returns a set with the hashes of the images that were already annotated.
+    '''
+
+    return {fname[:-len(".json")] for fname in os.listdir(HASH_DIR)}
+
+
+def make_bucket(images_per_minute=IMAGES_PER_MINUTE):
+    '''
+    Returns the TokenBucket that paces the requests of all the
+    workers to the API quota, with room for one whole batch.
+    '''
+
+    rate = images_per_minute / 60
+
+    return TokenBucket(rate, capacity=max(BATCH_SIZE, rate))
+
+
+def make_limit(n_workers=N_WORKERS):
+    '''
+    Returns the AdaptiveLimit of the batches in flight,
+    with one thread per batch at most.
+    '''
+
+    return AdaptiveLimit("vision", min(INITIAL_WORKERS, n_workers), n_workers)
+
+
+def annotate_batch(batch, bucket, limit, annotator, ledger_conn, log):
+    '''
+    Detects labels and safe search annotations for a batch of
+    local images with a single request to the annotator.
+    The result for each image is saved as a JSON file named
+    after the image hash, and the outcome in the job ledger
+    and the run log.
+
+    Params:
+    batch: a list of rows with the columns img_path, img_sha256, search_query and position
+    bucket: the TokenBucket that paces the requests to the API quota
+    limit: the AdaptiveLimit of the batches in flight
+    annotator: one of the backends in annotators.py
+    ledger_conn: a connection to the job ledger
+    log: the run log, as returned by runlog.get()
+    '''
+
+    rows, contents = [ ], [ ]
+
+    for row in batch:
+        print(f"Now looking at image {row.img_path}")
+
+        # A blob that went missing fails on its own, the rest of the batch is still sent
+        try:
+            contents.append(read_image(row.img_path))
+        except OSError as e:
+            print(f"Could not read image {row.img_path}: {e}")
+            record_failure([row], e, ledger_conn, log)
+            continue
+
+        rows.append(row)
+
+    batch = rows
+    if not batch:
+        return
+
+    start = time.monotonic()
+
+    for attempt in range(ledger.MAX_ATTEMPTS):
+
+        # Waits for a slot, then for enough quota to send the whole batch.
+        # The slot is given back whatever the request raises.
+        limit.acquire()
+        try:
+            bucket.acquire(len(contents))
+            request_start = time.monotonic()
+            results = annotator.annotate(contents)
+            error = None
+        except AnnotatorError as e:
+            error = e
+        finally:
+            limit.release()
+
+        if error is None:
+            limit.record(time.monotonic() - request_start)
+            break
+
+        limit.record(congested=not isinstance(error, QuotaError), throttled=isinstance(error, QuotaError))
+
+        print(f"Error in Cloud Vision API request for a batch of {len(batch)} images on attempt #{attempt + 1}: {error}")
+
+        if attempt == ledger.MAX_ATTEMPTS - 1:
+            for row, content in zip(batch, contents):
+                ledger.record(ledger_conn, ledger.VISION, row.search_query, row.position,
+                              type(error).__name__, attempt + 1)
+                runlog.event(log, ledger.VISION, row.search_query, row.position,
+                             latency=time.monotonic() - start, attempts=attempt + 1,
+                             error=type(error).__name__, message=str(error), size=len(content))
+            print(f"Giving up on a batch of {len(batch)} images. Check the run log for more information")
+            return
+
+        time.sleep(ledger.backoff(attempt))
+
+    latency = time.monotonic() - start
+
+    for row, content, r in zip(batch, contents, results):
+
+        # If there's an error with the image
+        if "error" in r:
+            ledger.record(ledger_conn, ledger.VISION, row.search_query, row.position, "ImageError", attempt + 1)
+            runlog.event(log, ledger.VISION, row.search_query, row.position, latency=latency,
+                         attempts=attempt + 1, error="ImageError", message=r["error"], size=len(content))
+            print(f"Error on {row.search_query} position #{row.position}, check the run log for more information")
+            continue
+
+        save_json(dict(path=row.img_path, **r), row.img_sha256)
+        ledger.record(ledger_conn, ledger.VISION, row.search_query, row.position, None, attempt + 1)
+        runlog.event(log, ledger.VISION, row.search_query, row.position, latency=latency,
+                     attempts=attempt + 1, size=len(content))
+
+        print(f"Sucessfully saved Cloud Vision data for query {row.search_query}, position #{row.position}")
+
+
+def record_failure(batch, error, ledger_conn, log):
+    '''
+    Records that every image of a batch failed with an error
+    that isn't an answer of the API, such as an image file that
+    can't be read or an error annotate_batch() didn't handle.
+    '''
+
+    for row in batch:
+        ledger.record(ledger_conn, ledger.VISION, row.search_query, row.position, type(error).__name__)
+        runlog.event(log, ledger.VISION, row.search_query, row.position, error=type(error).__name__,
+                     message=str(error), size=row.img_bytes)
+
+
+class AnnotationStream:
+    '''
+    Annotates images as they are downloaded. put() queues an image
+    and waits while the queue is full; `n_workers` workers take the
+    images already waiting, up to a full batch, and annotate them in
+    a pool of threads, as many at once as the AdaptiveLimit of the
+    stream allows. A batch that fails with an unexpected error is
+    recorded as failed, and its worker goes on with the next one.
+    start() and close() must be called from the event loop the
+    images are put from.
+
+    Params
+
+    annotator: one of the backends in annotators.py
+    root: the output directory of the run, whose run log gets the outcomes
+    ledger_conn: a connection to the job ledger
+    images_per_minute: API quota
+    n_workers: maximum number of batches in flight at the same time
+    queue_size: images waiting to be annotated before the downloads wait
+    '''
+
+    def __init__(self, annotator, root, ledger_conn, images_per_minute=IMAGES_PER_MINUTE,
+                 n_workers=N_WORKERS, queue_size=QUEUE_SIZE):
+
+        self.annotator = annotator
+        self.ledger_conn = ledger_conn
+        self.log = runlog.get(root)
+        self.bucket = make_bucket(images_per_minute)
+        self.limit = make_limit(n_workers)
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+        self.n_images = 0
+
+        if not os.path.exists(HASH_DIR):
+            os.makedirs(HASH_DIR)
+
+        # Images annotated before, or already queued, are not queued again
+        self.seen = annotated()
+
+    def start(self):
+
+        self.queue = asyncio.Queue(self.queue_size)
+        self.executor = ThreadPoolExecutor(self.n_workers)
+        self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.n_workers)]
+
+    async def put(self, search_query, position, path, digest, size):
+        '''
+        Queues a stored image to be annotated, unless its hash
+        was seen before. Waits while the queue is full.
+        '''
+
+        if digest in self.seen:
+            return
+        self.seen.add(digest)
+
+        ledger.add(self.ledger_conn, ledger.VISION, [(search_query, position)])
+
+        await self.queue.put(Image(search_query, position, path, digest, size))
+
+    async def work(self):
+
+        loop = asyncio.get_event_loop()
+
+        image = await self.queue.get()
+
+        while image is not DONE:
+
+            batch, batch_bytes = [image], image.img_bytes
+            image = None
+
+            # Adds the images already waiting, without waiting for more
+            while image is None and not self.queue.empty():
+                queued = self.queue.get_nowait()
+                if queued is DONE or len(batch) == BATCH_SIZE or batch_bytes + queued.img_bytes > MAX_BATCH_BYTES:
+                    image = queued
+                else:
+                    batch.append(queued)
+                    batch_bytes += queued.img_bytes
+
+            # An unexpected error only fails its batch, so the worker keeps
+            # emptying the queue and the downloads never wait on it forever
+            try:
+                await loop.run_in_executor(self.executor, annotate_batch, batch, self.bucket, self.limit,
+                                           self.annotator, self.ledger_conn, self.log)
+                self.n_images += len(batch)
+            except Exception as e:
+                print(f"Unexpected error annotating a batch of {len(batch)} images: {e!r}")
+                record_failure(batch, e, self.ledger_conn, self.log)
+
+            if image is None:
+                image = await self.queue.get()
+
+    async def close(self):
+        '''
+        Waits until every queued image is annotated.
+        '''
+
+        for _ in self.workers:
+            await self.queue.put(DONE)
+
+        await asyncio.gather(*self.workers)
+        self.executor.shutdown()
+
+        self.limit.report()
+
+
+def add_arguments(parser):
+    '''
+    Adds the options that choose and configure the
+    annotation backend to an argparse parser. By default
+    the images are sent to Cloud Vision; "--backend fake"
+    uses the offline stand-in instead, which is meant for
+    timing and testing.
+    '''
+
+    parser.add_argument("--backend", choices=["cloud", "fake"], default="cloud")
+    parser.add_argument("--images-per-minute", type=float, default=IMAGES_PER_MINUTE, help="API quota")
+    parser.add_argument("--workers", type=int, default=N_WORKERS, help="maximum number of batches in flight at the same time")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake backend: seconds per request")
+    parser.add_argument("--latency-per-image", type=float, default=0.0, help="fake backend: extra seconds per image")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake backend: share of images that fail")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="fake backend: share of requests over quota")
+    parser.add_argument("--seed", type=int, default=0, help="fake backend: seed for random failures")
+
+
+def make_annotator(args):
+
+    if args.backend == "fake":
+        return FakeAnnotator(latency=args.latency, latency_per_image=args.latency_per_image,
+                             error_rate=args.error_rate, quota_error_rate=args.quota_error_rate,
+                             seed=args.seed)
+
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.abspath(CREDENTIALS_PATH)
+
+    return CloudVisionAnnotator()
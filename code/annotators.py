@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Image annotation backends used by annotation.py.
+#
+# Every backend has an annotate(contents) method that takes a list of image
+# contents (bytes) and returns one result per image, in the same order.
+# A result is either the parsed annotations, as saved to the JSON files,
+# or a dictionary with a single "error" key for images the API rejected.
+# Failures of the whole request raise AnnotatorError, or QuotaError when
+# the API quota was exceeded.
+#
+# CloudVisionAnnotator calls the real Google Cloud Vision API. FakeAnnotator
+# returns deterministic, made-up annotations with configurable latency and
+# failure rates, so step 5 can be run and timed without credentials or quota.
+
+import hashlib
+import random
+import threading
+import time
+
+
+# Names of likelihood from google.cloud.vision.enums
+LIKELIHOOD_NAME = ('UNKNOWN', 'VERY_UNLIKELY', 'UNLIKELY', 'POSSIBLE',
+                   'LIKELY', 'VERY_LIKELY')
+
+SAFE_SEARCH_CATEGORIES = ("adult", "racy", "spoof", "medical", "violence")
+
+
+class AnnotatorError(Exception):
+    '''
+    Raised when a whole annotation request fails.
+    '''
+
+
+class QuotaError(AnnotatorError):
+    '''
+    Raised when the API refuses a request because the quota was exceeded.
+    '''
+
+
+class CloudVisionAnnotator:
+    '''
+    Annotates images with label detection and safe search detection
+    using batch_annotate_images requests to Google Cloud Vision.
+    Each thread creates its API client once and reuses it.
+    '''
+
+    def __init__(self):
+
+        # Imported here so the other backends work without the Google libraries
+        from google.cloud import vision
+        from google.api_core import exceptions
+
+        self.vision = vision
+        self.exceptions = exceptions
+        self.local = threading.local()
+
+        self.features = [{'type_': vision.Feature.Type.LABEL_DETECTION},
+                         {'type_': vision.Feature.Type.SAFE_SEARCH_DETECTION}]
+
+    def get_client(self):
+
+        if not hasattr(self.local, "client"):
+            self.local.client = self.vision.ImageAnnotatorClient()
+
+        return self.local.client
+
+    def parse(self, response):
+        '''
+        Formats the Cloud Vision API response
+        in a JSON-like format.
+        '''
+
+        safe_search = response.safe_search_annotation
+
+        safe_search_annotations = {
+            category: {"likelihood": LIKELIHOOD_NAME[getattr(safe_search, category)]}
+            for category in SAFE_SEARCH_CATEGORIES
+        }
+
+        label_annotations = [ ]
+
+        for label in response.label_annotations:
+            label_annotations.append({
+                "mid": label.mid,
+                "score": float(label.score),
+                "topicality": float(label.topicality),
+                "description": label.description
+            })
+
+        return {
+            "label_annotations": label_annotations,
+            "safe_search_annotations": safe_search_annotations
+        }
+
+    def annotate(self, contents):
+
+        image_requests = [{"image": self.vision.Image(content=content), "features": self.features}
+                          for content in contents]
+
+        try:
+            response = self.get_client().batch_annotate_images(requests=image_requests)
+        except self.exceptions.ResourceExhausted as e:
+            raise QuotaError(str(e))
+        except self.exceptions.GoogleAPICallError as e:
+            raise AnnotatorError(str(e))
+
+        return [ {"error": r.error.message} if r.error.message else self.parse(r)
+                 for r in response.responses ]
+
+
+class FakeAnnotator:
+    '''
+    In-process stand-in for Cloud Vision. The annotations of an
+    image are derived from the hash of its content, so the same
+    image always gets the same result.
+
+    Params
+
+    latency: seconds each request takes
+    latency_per_image: extra seconds per image in the request
+    error_rate: share of images that come back with an error
+    quota_error_rate: share of requests that fail with a QuotaError
+    seed: seed for the random failures
+    '''
+
+    LABELS = ("Hair", "Face", "Smile", "Fashion", "Beauty", "Dress",
+              "Photograph", "Model", "Skin", "Event", "Happy", "Lip")
+
+    def __init__(self, latency=0.2, latency_per_image=0.0, error_rate=0.0,
+                 quota_error_rate=0.0, seed=0):
+
+        self.latency = latency
+        self.latency_per_image = latency_per_image
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def annotate_one(self, content):
+
+        digest = hashlib.sha256(content).digest()
+
+        # Whether an image fails only depends on its content,
+        # so reruns fail on the same images
+        if digest[0] / 256 < self.error_rate:
+            return {"error": "Bad image data."}
+
+        safe_search_annotations = {
+            category: {"likelihood": LIKELIHOOD_NAME[1 + digest[i] % 5]}
+            for i, category in enumerate(SAFE_SEARCH_CATEGORIES, start=1)
+        }
+
+        label_annotations = [ ]
+
+        for i in range(digest[6] % 5 + 1):
+            score = digest[7 + i] / 255
+            label_annotations.append({
+                "mid": f"/m/fake{digest[7 + i] % len(self.LABELS)}",
+                "score": score,
+                "topicality": score,
+                "description": self.LABELS[digest[7 + i] % len(self.LABELS)]
+            })
+
+        return {
+            "label_annotations": label_annotations,
+            "safe_search_annotations": safe_search_annotations
+        }
+
+    def annotate(self, contents):
+
+        time.sleep(self.latency + self.latency_per_image * len(contents))
+
+        with self.lock:
+            quota_exceeded = self.random.random() < self.quota_error_rate
+
+        if quota_exceeded:
+            raise QuotaError("429 Quota exceeded for quota metric 'Requests' (fake)")
+
+        return [self.annotate_one(content) for content in contents]
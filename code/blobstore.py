@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Content-addressed image store.
+#
+# Images are saved under the SHA-256 hash of their content, so an image that
+# shows up in the results of several queries is kept on disk only once. The
+# download manifest maps each (search_query, position) pair to its blob.
+
+import hashlib
+import os
+
+
+BLOB_DIR = "../output/blobs"
+
+# Where downloads are written while they are still in progress
+TMP_DIR = f"{BLOB_DIR}/.tmp"
+
+CHUNK_SIZE = 64 * 1024
+
+
+def blob_path(digest, extension):
+    '''
+    Returns the path of the blob with the given hash. Blobs are
+    spread over 256 subdirectories named after the first two
+    characters of the hash, to keep each directory small.
+    '''
+
+    return f"{BLOB_DIR}/{digest[:2]}/{digest}.{extension}"
+
+
+def store(tmp_path, digest, extension):
+    '''
+    Moves a finished download into the store and returns its path.
+    If the same content is already stored, the new copy is discarded.
+
+    Params
+
+    tmp_path: the path of the downloaded file
+    digest: the SHA-256 hex digest of its content
+    extension: the file extension derived from its content type
+    '''
+
+    path = blob_path(digest, extension)
+
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        return path
+
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def hash_file(path):
+    '''
+    Returns the SHA-256 hex digest of a file on disk.
+    '''
+
+    sha = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
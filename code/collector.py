@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Concurrent SerpAPI collector used by 1.data-collection.py.
+#
+# Searches are sent straight to SerpAPI's JSON endpoint with aiohttp. A
+# configurable number of workers pull them from a shared queue, under a
+# requests-per-second limit, and searches that are throttled or fail are
+# retried with jittered exponential backoff. Searches that still fail are
+# logged and no result file is written for them, so the next run tries
+# them again. The endpoint can point to fake_serpapi.py for testing.
+#
+# Google Images returns about 100 results per page. Deeper result sets are
+# collected page by page with SerpAPI's `ijn` parameter: page 0 is saved as
+# <name>.json, like before, and page n as <name>.page-<n>.json. Each page is
+# written as soon as it arrives, with positions renumbered so that they
+# continue from one page to the next. Pages already on disk are skipped, so
+# a query that was interrupted resumes from where it stopped, and a page
+# without results marks the end of a query.
+#
+# Results go to <root>/search_results and the outcome of every search to the
+# run log in <root>/logs (see runlog.py), where the root is ../output unless
+# a job says otherwise, as sweeps do (see sweep.py).
+
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+import ledger
+from ledger import backoff
+from ratelimit import AsyncTokenBucket
+import runlog
+import workqueue
+
+
+ENDPOINT = "https://serpapi.com/search.json"
+
+# Searches in flight at the same time
+CONCURRENCY = 8
+
+# Searches started per second
+REQUESTS_PER_SECOND = 4
+
+# Attempts per search before giving up
+MAX_ATTEMPTS = 5
+
+# Seconds to wait for a search to finish
+TIMEOUT = 120
+
+# Results per page of Google Images, used to number positions across pages
+PAGE_SIZE = 100
+
+# Pages collected per query
+PAGES = 1
+
+# What SerpAPI answers when a page is past the last result
+NO_RESULTS = "hasn't returned any results"
+
+OUTPUT_ROOT = "../output"
+
+
+class SearchError(Exception):
+    '''
+    Raised when a search fails. `retry` tells if it
+    is worth trying again, as with throttling or
+    server errors, or not, as with an invalid API key.
+    `error` is the class of the error for the run log,
+    and `status` the HTTP status of the response, if any.
+    '''
+
+    def __init__(self, message, retry, error, status=None):
+
+        super().__init__(message)
+        self.retry = retry
+        self.error = error
+        self.status = status
+
+
+def result_path(name, page=0, root=OUTPUT_ROOT):
+
+    slug = name.replace(' ','-').lower()
+
+    if page == 0:
+        return f"{root}/search_results/{slug}.json"
+
+    return f"{root}/search_results/{slug}.page-{page}.json"
+
+
+def saved_results(name, page=0, root=OUTPUT_ROOT):
+    '''
+    Returns the number of results saved for a page of a search,
+    or None if it wasn't collected yet. Files written by older
+    versions of this script for failed searches only hold an
+    error message and don't count.
+    '''
+
+    try:
+        with open(result_path(name, page, root)) as f:
+            results = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if "images_results" not in results:
+        return None
+
+    return len(results["images_results"])
+
+
+def number_positions(results, page):
+    '''
+    Renumbers the results of a page so that positions continue
+    from the previous pages: page n holds positions n * PAGE_SIZE + 1
+    onwards. The position within the page is kept as page_position.
+    '''
+
+    for i, result in enumerate(results["images_results"]):
+        result["page_position"] = result.get("position")
+        result["position"] = page * PAGE_SIZE + i + 1
+
+    return results
+
+
+async def search(session, params, endpoint):
+    '''
+    Makes a single request to SerpAPI and returns the parsed
+    JSON. Raises SearchError if the search failed.
+    '''
+
+    try:
+        async with session.get(endpoint, params=params) as r:
+
+            if r.status == 429 or r.status >= 500:
+                raise SearchError(f"HTTP {r.status}", retry=True, error=f"HTTP {r.status}", status=r.status)
+
+            try:
+                results = await r.json(content_type=None)
+            except ValueError:
+                if r.status != 200:
+                    raise SearchError(f"HTTP {r.status}", retry=False, error=f"HTTP {r.status}", status=r.status)
+                raise SearchError("Invalid JSON", retry=True, error="InvalidJSON", status=r.status)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise SearchError(f"{type(e).__name__} {e}", retry=True, error=type(e).__name__)
+
+    if r.status != 200:
+        raise SearchError(results.get("error", f"HTTP {r.status}"), retry=False, error=f"HTTP {r.status}",
+                          status=r.status)
+
+    # Searches without results, as when paging past the last one, are reported as errors
+    if NO_RESULTS in results.get("error", ""):
+        return dict(results, images_results=[ ])
+
+    # SerpAPI also reports other errors with a 200 status
+    if "error" in results:
+        raise SearchError(results["error"], retry=False, error="APIError", status=r.status)
+
+    return results
+
+
+async def image_search(session, bucket, ends, job, endpoint):
+    '''
+    Fetches one page of a Google Image Search using SerpApi,
+    retrying failed attempts. The results are saved in JSON format.
+
+    Params
+
+    session: an aiohttp.ClientSession
+    bucket: the AsyncTokenBucket that paces the searches
+    ends: dictionary with the first empty page found for each search,
+          shared by all the pages so that no page past it is fetched
+    job: a dictionary with the query ("q"), the other SerpAPI parameters
+         ("params"), the name of the JSON file ("name"), the page
+         number ("page") and, optionally, the output root ("root")
+    endpoint: the SerpAPI search endpoint
+    '''
+
+    name, page = job["name"], job["page"]
+    root = job.get("root", OUTPUT_ROOT)
+
+    params = dict(job["params"], q=job["q"].lower())
+    if page > 0:
+        params["ijn"] = page
+
+    if ends.get((root, name), page + 1) < page:
+        return
+
+    log = runlog.get(root)
+    start = time.monotonic()
+
+    for attempt in range(MAX_ATTEMPTS):
+
+        await bucket.acquire()
+
+        try:
+            results = await search(session, params, endpoint)
+            break
+
+        except SearchError as e:
+            print(f">> Search for '{job['q']}' page {page} failed on attempt #{attempt + 1}: {e}")
+
+            if not e.retry or attempt == MAX_ATTEMPTS - 1:
+                runlog.event(log, ledger.SEARCH, job["q"], page, endpoint, e.status, time.monotonic() - start,
+                             attempt + 1, e.error, str(e))
+                return
+
+            await asyncio.sleep(backoff(attempt))
+
+    if not results["images_results"]:
+        ends[root, name] = min(ends.get((root, name), page), page)
+
+    with open(result_path(name, page, root), "w+") as f:
+        json.dump(number_positions(results, page), f, indent=4)
+
+    runlog.event(log, ledger.SEARCH, job["q"], page, endpoint, 200, time.monotonic() - start, attempt + 1)
+
+    print(f"> Saved {len(results['images_results'])} results for '{job['q']}' page {page}")
+
+
+async def collect_all(jobs, ends, endpoint=ENDPOINT, concurrency=CONCURRENCY,
+                      requests_per_second=REQUESTS_PER_SECOND):
+    '''
+    Runs all the searches with `concurrency` workers pulling
+    from a shared queue, starting at most `requests_per_second`
+    per second.
+    '''
+
+    bucket = AsyncTokenBucket(requests_per_second)
+
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        # All the searches go to the same host
+        await workqueue.run(jobs, lambda job: image_search(session, bucket, ends, job, endpoint),
+                            concurrency, concurrency, host=lambda job: endpoint)
+
+
+def plan_pages(jobs, pages):
+    '''
+    Lists the pages still to be collected for each search,
+    skipping the ones already saved and the ones after an
+    empty page. Returns the list of page jobs, ordered by
+    page so that every search advances at the same pace,
+    and the ends already known.
+    '''
+
+    planned, ends = [ ], { }
+
+    for job in jobs:
+
+        root = job.get("root", OUTPUT_ROOT)
+
+        for page in range(pages):
+
+            n_results = saved_results(job["name"], page, root)
+
+            if n_results is None:
+                planned.append(dict(job, page=page))
+            elif n_results == 0:
+                ends[root, job["name"]] = page
+                break
+
+    planned.sort(key=lambda job: job["page"])
+
+    return planned, ends
+
+
+def run(jobs, pages=PAGES, **kwargs):
+    '''
+    Synchronous entry point. Skips the pages whose results
+    were already saved and runs collect_all() on the event loop.
+
+    Params
+
+    jobs: a list of dictionaries as expected by image_search(), without the page
+    pages: number of pages to collect for each search
+    '''
+
+    for root in {job.get("root", OUTPUT_ROOT) for job in jobs}:
+        for directory in [f"{root}/search_results", f"{root}/logs"]:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    jobs, ends = plan_pages(jobs, pages)
+
+    print(f"> Running {len(jobs)} searches")
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(collect_all(jobs, ends, **kwargs))
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Asynchronous image download engine used by 2.image-download.py.
+#
+# Instead of fetching the ~100 images of a query one after the other, every
+# image URL of every search result file goes into one shared work queue (see
+# workqueue.py), and a pool of workers, one per connection, pulls images from
+# it until it is empty. At most a few images of the same host are in flight
+# at once, over keep-alive connections, so a slow host only holds back its own
+# images. Images are saved in the content-addressed blob store.
+#
+# Images that were downloaded before are requested again conditionally, with
+# the validators of the last response, and a "304 Not Modified" answer keeps
+# the stored blob without downloading the image again.
+#
+# Failures are retried with backoff when they are worth retrying, and the
+# outcome of every image is recorded in the job ledger (see ledger.py) and
+# the run log (see runlog.py). Hosts that stop answering are skipped for a
+# while, so their images fail at once instead of after a timeout each.
+#
+# The number of requests in flight adapts to the network, between one and
+# the number of connections (see ratelimit.py): it grows while the downloads
+# stay fast and seldom time out, and it is cut when they slow down, time out
+# or are throttled.
+#
+# Search results come with a thumbnail, as a URL on Google's thumbnail host
+# or inline as a base64 "data:" URI. When a result has one, its original image
+# gets DEADLINE seconds, retries included, and the thumbnail is stored instead
+# if the original fails or runs out of time, so a slow or broken host costs a
+# lower resolution image rather than the image. Thumbnail URLs go through the
+# same work queue and circuit breaker as the originals. The failure of the
+# original is still recorded, so later runs try it again, and the manifest
+# tells which variant was stored.
+#
+# Given an AnnotationStream (see annotation.py), every image is also queued to
+# be annotated as soon as it is stored, so downloads and annotations overlap.
+
+import asyncio
+import base64
+import hashlib
+import os
+import time
+import aiohttp
+
+import blobstore
+import imageinfo
+import ledger
+import manifest
+from ratelimit import AsyncAdaptiveLimit
+import runlog
+import workqueue
+
+
+USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:15.0) Gecko/20100101 Firefox/15.0.1"
+
+# Total number of simultaneous connections, and requests in flight to start with
+MAX_CONNECTIONS = 64
+INITIAL_CONNECTIONS = 16
+
+# Simultaneous connections to a single host
+MAX_CONNECTIONS_PER_HOST = 4
+
+# Seconds to wait for a server before giving up
+TIMEOUT = 10
+
+# Seconds the original image gets, retries included, before falling back to the thumbnail
+DEADLINE = 20
+
+CHUNK_SIZE = blobstore.CHUNK_SIZE
+
+
+def conditional_headers(cached):
+    '''
+    Returns the headers that ask the server to only send a response
+    body if the resource changed since it was cached. `cached` is a
+    dictionary with the keys etag and last_modified, or None.
+    '''
+
+    headers = { }
+
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    return headers
+
+
+async def download_image(session, job, conn, variant=manifest.ORIGINAL):
+    '''
+    Downloads a single image and saves it in the blob store under the hash
+    of its content. The first bytes of the response are checked to make sure
+    it is an image, and the rest is written to a temporary name and hashed as
+    it arrives. The file is only moved into the store once it is complete and
+    readable, so an interrupted run never leaves a partial file behind.
+    The outcome, including the image format and dimensions, is recorded in
+    the download manifest. Returns the HTTP status, the size, the path
+    and the hash of the image, or raises ledger.JobError if the download
+    failed.
+
+    Params
+
+    session: an aiohttp.ClientSession
+    job: a dictionary with the keys "search_query", "url" and "position" and,
+         if the URL was downloaded before, "cached", its entry in the URL index and,
+         if the search result has one, "thumbnail", the URL of its thumbnail
+    conn: a connection to the download manifest
+    variant: manifest.ORIGINAL, or manifest.THUMBNAIL to download the thumbnail
+             at job["thumbnail"] instead
+    '''
+
+    search_query, position = job["search_query"], job["position"]
+    url = job["url"] if variant == manifest.ORIGINAL else job["thumbnail"]
+    cached = job.get("cached") if variant == manifest.ORIGINAL else None
+
+    print(f">> Fetching {variant} #{position} at url {url}")
+
+    try:
+        async with session.get(url, headers=conditional_headers(cached)) as r:
+
+            etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+            # The image didn't change: the blob downloaded before is kept
+            if r.status == 304 and cached:
+                print(f">> Not modified on url {url}, position #{position}")
+                manifest.record(conn, search_query, position, url, cached["path"], cached["content_type"],
+                                cached["bytes"], r.status, cached["sha256"], cached["format"],
+                                cached["width"], cached["height"],
+                                etag or cached["etag"], last_modified or cached["last_modified"])
+                return r.status, cached["bytes"], cached["path"], cached["sha256"]
+
+            if r.status != 200:
+                print(f">> Status code error {r.status} on url {url}, position #{position}")
+                manifest.record(conn, search_query, position, job["url"], status=r.status, variant=variant)
+                raise ledger.http_error(r.status)
+
+            content_type = r.headers.get("content-type")
+
+            # Reads the first bytes to determine the file type.
+            # Responses that aren't images are dropped without reading the rest.
+            head = b""
+            while len(head) < imageinfo.HEAD_SIZE:
+                chunk = await r.content.read(imageinfo.HEAD_SIZE - len(head))
+                if not chunk:
+                    break
+                head += chunk
+
+            extension = imageinfo.sniff(head)
+            if extension is None:
+                print(f">> Not an image ({content_type}) on url {url}, position #{position}")
+                manifest.record(conn, search_query, position, job["url"], content_type=content_type,
+                                status=r.status, variant=variant)
+                raise ledger.JobError("NotAnImage", retry=False, status=r.status)
+
+            # Saves file
+            tmp_path = f"{blobstore.TMP_DIR}/{search_query.replace(' ', '-')}-{position}.part"
+
+            sha = hashlib.sha256(head)
+            size = len(head)
+            try:
+                with open(tmp_path, "wb") as out_file:
+                    out_file.write(head)
+                    async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                        out_file.write(chunk)
+                        sha.update(chunk)
+                        size += len(chunk)
+
+            # Whether the connection failed or the deadline cancelled the download
+            except (Exception, asyncio.CancelledError):
+                os.remove(tmp_path)
+                raise
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        print(f">> Connection error found in url {url}, position #{position}")
+        manifest.record(conn, search_query, position, job["url"], variant=variant)
+        # Invalid URLs and the like fail the same way every time
+        raise ledger.JobError(type(e).__name__, retry=isinstance(e, (aiohttp.ClientConnectionError,
+                                                                      aiohttp.ClientPayloadError,
+                                                                      asyncio.TimeoutError)))
+
+    fpath = await store_image(conn, job, tmp_path, sha.hexdigest(), extension, size, r.status,
+                              content_type, etag, last_modified, variant)
+
+    return r.status, size, fpath, sha.hexdigest()
+
+
+async def store_image(conn, job, tmp_path, digest, extension, size, status, content_type=None,
+                      etag=None, last_modified=None, variant=manifest.ORIGINAL):
+    '''
+    Checks that a complete temporary file can be read as an image,
+    moves it into the blob store and records it in the download
+    manifest. Returns its path in the store, or raises
+    ledger.JobError if it is broken.
+    '''
+
+    search_query, position = job["search_query"], job["position"]
+
+    # Checks that the whole file can be read as an image, off the event loop
+    loop = asyncio.get_event_loop()
+    try:
+        image_format, width, height = await loop.run_in_executor(None, imageinfo.inspect, tmp_path)
+    except ValueError:
+        print(f">> Broken {variant} on url {job['url']}, position #{position}")
+        os.remove(tmp_path)
+        manifest.record(conn, search_query, position, job["url"], content_type=content_type, status=status,
+                        variant=variant)
+        raise ledger.JobError("BrokenImage", retry=False, status=status)
+    except asyncio.CancelledError:
+        os.remove(tmp_path)
+        raise
+
+    fpath = blobstore.store(tmp_path, digest, extension)
+
+    manifest.record(conn, search_query, position, job["url"], fpath, content_type, size, status, digest,
+                    image_format, width, height, etag, last_modified, variant)
+
+    return fpath
+
+
+def decode_data_uri(uri):
+    '''
+    Returns the content and the media type of a base64
+    "data:" URI, or raises ValueError if it isn't one.
+    '''
+
+    header, _, data = uri.partition(",")
+
+    if not header.startswith("data:") or not header.endswith(";base64"):
+        raise ValueError(f"Not a base64 data URI: {header[:40]}")
+
+    return base64.b64decode(data, validate=True), header[len("data:"):-len(";base64")]
+
+
+async def decode_thumbnail(job, conn):
+    '''
+    Saves the thumbnail of a search result that SerpAPI sent inline,
+    as a "data:" URI, like download_image() saves a download.
+    Returns None for the HTTP status, and the size, the path and
+    the hash of the image, or raises ledger.JobError.
+    '''
+
+    search_query, position = job["search_query"], job["position"]
+
+    print(f">> Decoding thumbnail #{position} of url {job['url']}")
+
+    try:
+        content, content_type = decode_data_uri(job["thumbnail"])
+    except ValueError:
+        manifest.record(conn, search_query, position, job["url"], variant=manifest.THUMBNAIL)
+        raise ledger.JobError("BrokenImage", retry=False)
+
+    extension = imageinfo.sniff(content[:imageinfo.HEAD_SIZE])
+    if extension is None:
+        manifest.record(conn, search_query, position, job["url"], content_type=content_type,
+                        variant=manifest.THUMBNAIL)
+        raise ledger.JobError("NotAnImage", retry=False)
+
+    tmp_path = f"{blobstore.TMP_DIR}/{search_query.replace(' ', '-')}-{position}.part"
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(content)
+
+    digest = hashlib.sha256(content).hexdigest()
+
+    fpath = await store_image(conn, job, tmp_path, digest, extension, len(content), None, content_type,
+                              variant=manifest.THUMBNAIL)
+
+    return None, len(content), fpath, digest
+
+
+def job_host(job):
+    '''
+    Returns the host a download job requests: the host
+    of the thumbnail for the fallback to a thumbnail.
+    '''
+
+    if job.get("variant") == manifest.THUMBNAIL:
+        return workqueue.url_host({"url": job["thumbnail"]})
+
+    return workqueue.url_host(job)
+
+
+async def finish(stage, job, url, result, error, attempts, start, ledger_conn, log, stream):
+    '''
+    Records the outcome of a download or of the fallback to
+    its thumbnail in the job ledger and the run log and, if
+    there is a stream, queues the image to be annotated.
+    '''
+
+    if error is None:
+        status, size, fpath, digest = result
+
+        # Waits here while the annotation queue is full
+        if stream is not None:
+            await stream.put(job["search_query"], job["position"], fpath, digest, size)
+    else:
+        status, size = error.status, None
+
+    ledger.record(ledger_conn, stage, job["search_query"], job["position"], error, attempts)
+    runlog.event(log, stage, job["search_query"], job["position"], url, status,
+                 time.monotonic() - start, attempts, error, size=size)
+
+
+async def download_thumbnail(session, job, conn, ledger_conn, log, breaker, limit, stream=None):
+    '''
+    Stores the thumbnail of a search result in place of its original
+    image, decoding it if it was sent inline and downloading it
+    otherwise, and records the outcome as a THUMBNAIL job.
+    '''
+
+    start = time.monotonic()
+
+    if job["thumbnail"].startswith("data:"):
+        result, error, attempts = await ledger.attempt(lambda: decode_thumbnail(job, conn), max_attempts=1)
+        url = None
+    else:
+        result, error, attempts = await ledger.attempt(lambda: download_image(session, job, conn, manifest.THUMBNAIL),
+                                                       breaker=breaker, host=job_host(job), limit=limit)
+        url = job["thumbnail"]
+
+    await finish(ledger.THUMBNAIL, job, url, result, error, attempts, start, ledger_conn, log, stream)
+
+
+async def download(session, job, conn, ledger_conn, log, breaker, limit, stream=None, deadline=DEADLINE):
+    '''
+    Downloads an image with download_image(), retrying the failures
+    worth retrying while `breaker` allows its host, and records the
+    outcome in the job ledger and the run log. Each attempt waits
+    for a slot of `limit`, the AsyncAdaptiveLimit of the stage.
+    If there is a stream, the image is then queued to be annotated.
+
+    If the search result has a thumbnail, the original image gets
+    `deadline` seconds. If it fails or runs out of time, its failure
+    is recorded, and the thumbnail is stored instead: at once if it
+    was sent inline, or else by returning a job for it, which waits
+    for a turn of its host in the work queue.
+    '''
+
+    if job.get("variant") == manifest.THUMBNAIL:
+        await download_thumbnail(session, job, conn, ledger_conn, log, breaker, limit, stream)
+        return None
+
+    start = time.monotonic()
+    thumbnail = job.get("thumbnail")
+
+    result, error, attempts = await ledger.attempt(lambda: download_image(session, job, conn),
+                                                   breaker=breaker, host=job_host(job), limit=limit,
+                                                   deadline=deadline if thumbnail else None)
+
+    await finish(ledger.DOWNLOAD, job, job["url"], result, error, attempts, start, ledger_conn, log, stream)
+
+    if error is None or not thumbnail:
+        return None
+
+    print(f">> Falling back to the thumbnail of url {job['url']}, position #{job['position']} ({error})")
+
+    if thumbnail.startswith("data:"):
+        await download_thumbnail(session, job, conn, ledger_conn, log, breaker, limit, stream)
+        return None
+
+    return [dict(job, variant=manifest.THUMBNAIL)]
+
+
+async def download_all(jobs, conn, ledger_conn, log, stream=None, max_connections=MAX_CONNECTIONS,
+                       initial_connections=INITIAL_CONNECTIONS,
+                       max_connections_per_host=MAX_CONNECTIONS_PER_HOST, timeout=TIMEOUT, deadline=DEADLINE):
+    '''
+    Downloads all the jobs through one shared, keep-alive connection
+    pool, with one worker per connection pulling from a shared queue.
+
+    Params
+
+    jobs: a list of dictionaries as expected by download_image()
+    conn: a connection to the download manifest
+    ledger_conn: a connection to the job ledger
+    log: the run log, as returned by runlog.get()
+    stream: an annotation.AnnotationStream that annotates the images as they are stored, or None
+    max_connections: global cap on simultaneous connections, and on the requests in flight
+    initial_connections: requests in flight to start with, before the limit adapts
+    max_connections_per_host: cap on simultaneous connections to the same host
+    timeout: seconds to wait for a server to connect or send data
+    deadline: seconds before falling back to the thumbnail of a search result
+    '''
+
+    connector = aiohttp.TCPConnector(limit=max_connections,
+                                     limit_per_host=max_connections_per_host)
+
+    client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+
+    breaker = workqueue.CircuitBreaker()
+    limit = AsyncAdaptiveLimit("downloads", initial_connections, max_connections)
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=client_timeout,
+                                     headers={"User-Agent": USER_AGENT}) as session:
+
+        if stream is not None:
+            stream.start()
+
+        await workqueue.run(jobs, lambda job: download(session, job, conn, ledger_conn, log, breaker, limit, stream,
+                                                    deadline),
+                            max_connections, max_connections_per_host, job_host)
+
+        if stream is not None:
+            await stream.close()
+
+    limit.report()
+
+
+def run(jobs, conn, ledger_conn, log, **kwargs):
+    '''
+    Synchronous entry point. Creates the temporary download
+    directory and runs download_all() on the event loop.
+    '''
+
+    if not os.path.exists(blobstore.TMP_DIR):
+        os.makedirs(blobstore.TMP_DIR)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(download_all(jobs, conn, ledger_conn, log, **kwargs))
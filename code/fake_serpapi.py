@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Local stand-in for SerpAPI's search endpoint, to test and time
+# 1.data-collection.py without an API key or quota:
+#
+#     python fake_serpapi.py --port 8000 --latency 1 --throttle-rate 0.2
+#     python 1.data-collection.py --endpoint http://localhost:8000/search.json
+#
+# Every search returns the same number of made-up image results on each of
+# its pages, and SerpAPI's "no results" error past the last page. Some
+# responses can be made to fail with 429 or 503 errors.
+
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+
+
+def make_results(params, n_results):
+    '''
+    Builds a response in the same format as SerpAPI's Google Images results.
+    '''
+
+    query = params.get("q", "")
+    page = int(params.get("ijn", 0))
+    slug = query.replace(" ", "-")
+
+    images_results = [ ]
+    for position in range(1, n_results + 1):
+        n = page * n_results + position
+        images_results.append({
+            "position": position,
+            "thumbnail": f"https://example.com/thumbs/{slug}/{n}.jpg",
+            "source": "example.com",
+            "title": f"{query} #{n}",
+            "link": f"https://example.com/{slug}/{n}",
+            "original": f"https://example.com/images/{slug}/{n}.jpg"
+        })
+
+    return {
+        "search_metadata": {"status": "Success"},
+        "search_parameters": dict(params),
+        "search_information": {"query_displayed": query},
+        "images_results": images_results
+    }
+
+
+def make_app(latency, throttle_rate, error_rate, n_results, n_pages):
+
+    async def handle_search(request):
+
+        await asyncio.sleep(latency)
+
+        if random.random() < throttle_rate:
+            return web.json_response({"error": "Too many requests"}, status=429)
+
+        if random.random() < error_rate:
+            return web.json_response({"error": "Service unavailable"}, status=503)
+
+        if int(request.query.get("ijn", 0)) >= n_pages:
+            return web.json_response({"error": "Google hasn't returned any results for this query."})
+
+        return web.json_response(make_results(request.query, n_results))
+
+    app = web.Application()
+    app.router.add_get("/search.json", handle_search)
+
+    return app
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Fake SerpAPI endpoint")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per search")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of searches answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of searches answered with 503")
+    parser.add_argument("--results", type=int, default=100, help="image results per page")
+    parser.add_argument("--pages", type=int, default=10, help="pages of results per search")
+    args = parser.parse_args()
+
+    app = make_app(args.latency, args.throttle_rate, args.error_rate, args.results, args.pages)
+    web.run_app(app, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Image validation used by the downloader.
+#
+# The first bytes of every download are checked against the signatures of
+# the formats Cloud Vision accepts, so HTML error pages and other non-image
+# responses are dropped before they are saved. Finished files are then opened
+# once with PIL to check them and read their dimensions, which are kept in
+# the download manifest for the later steps.
+
+from PIL import Image
+
+
+# Number of bytes needed to recognize every signature below
+HEAD_SIZE = 16
+
+# (offset, signature, format)
+SIGNATURES = [
+    (0, b"\xff\xd8\xff", "jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "png"),
+    (0, b"GIF87a", "gif"),
+    (0, b"GIF89a", "gif"),
+    (8, b"WEBP", "webp"),
+    (0, b"BM", "bmp"),
+    (0, b"II*\x00", "tiff"),
+    (0, b"MM\x00*", "tiff"),
+    (0, b"\x00\x00\x01\x00", "ico"),
+]
+
+
+def sniff(head):
+    '''
+    Returns the image format matching the first bytes
+    of a file, or None if they don't look like an image.
+
+    Params
+
+    head: at least the first HEAD_SIZE bytes of the file
+    '''
+
+    for offset, signature, image_format in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+
+            # WEBP files are RIFF containers
+            if image_format == "webp" and head[:4] != b"RIFF":
+                continue
+
+            return image_format
+
+    return None
+
+
+def inspect(path):
+    '''
+    Checks that a file is a readable image and returns
+    its format and dimensions as (format, width, height).
+    Raises ValueError if it is not.
+    '''
+
+    try:
+        with Image.open(path) as im:
+            image_format = im.format.lower()
+            width, height = im.size
+            im.verify()
+    except Exception as e:
+        raise ValueError(f"{path} is not a valid image: {e}")
+
+    return image_format, width, height
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Job ledger of the network stages.
+#
+# Steps 2, 3 and 5 record the outcome of every job, one per stage, query and
+# position, in a SQLite table of the run: whether it is pending, done or
+# failed, how many attempts it took over all the runs and the class of the
+# last error, such as "HTTP 503", "ClientConnectorError" or "QuotaError".
+#
+# Jobs that fail with an error worth retrying (connection errors, timeouts,
+# throttling and server errors) are retried on the spot with exponential
+# backoff, unless their host stopped answering altogether. Jobs that still
+# fail stay in the ledger as failed, and the steps' --retry-failed option runs
+# only those, instead of everything that is not done yet. Running this file
+# prints a summary of the ledger:
+#
+#     python ledger.py [--language local]
+
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import runs
+
+
+ROOT = "../output"
+
+LEDGER_PATH = "{root}/dataset/job-ledger.sqlite"
+
+# Names of the stages in the ledger and the run log (see runlog.py).
+# THUMBNAIL is the fallback of a download whose original image failed.
+SEARCH, DOWNLOAD, THUMBNAIL, TITLE, VISION = "search", "download", "thumbnail", "title", "vision"
+
+PENDING, DONE, FAILED = "pending", "done", "failed"
+
+# Attempts per job and per run before it is left as failed
+MAX_ATTEMPTS = 3
+
+# Base and maximum seconds to wait before retrying
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# HTTP statuses worth retrying: timeouts, throttling and server errors
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Step 5 records from several threads
+lock = threading.Lock()
+
+
+class JobError(Exception):
+    '''
+    Raised when a job fails. The message is the class
+    of the error, and `retry` tells if it is worth trying
+    again, as with a timeout, or not, as with a 404.
+    `status` is the HTTP status of the response, if any.
+    '''
+
+    def __init__(self, message, retry, status=None):
+
+        super().__init__(message)
+        self.retry = retry
+        self.status = status
+
+
+def backoff(attempt):
+    '''
+    Seconds to wait before retrying after the given attempt,
+    using "full jitter": a random time between zero and an
+    exponentially growing cap, so that jobs that failed
+    together don't all retry together.
+    '''
+
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def http_error(status):
+
+    return JobError(f"HTTP {status}", retry=status in RETRY_STATUSES, status=status)
+
+
+def unreachable(error):
+    '''
+    Tells if a JobError means that the host didn't answer at
+    all, as with connection errors and timeouts.
+    '''
+
+    return error.retry and error.status is None
+
+
+def timed_out(error):
+
+    return str(error).endswith("TimeoutError")
+
+
+async def attempt(run_once, max_attempts=MAX_ATTEMPTS, breaker=None, host=None, limit=None, deadline=None):
+    '''
+    Awaits `run_once()` until it succeeds, raises a JobError
+    that is not worth retrying or fails `max_attempts` times,
+    waiting between attempts. Returns what `run_once()`
+    returned, or None if it failed, the JobError of the last
+    attempt, or None, and the number of attempts.
+
+    With a workqueue.CircuitBreaker, attempts are only made while
+    the breaker allows the host, and their outcome is reported to it.
+    A job whose host is skipped fails with a "CircuitOpen" error.
+
+    With a ratelimit.AsyncAdaptiveLimit, each attempt waits for a
+    slot, and its latency is reported to the limit, as well as
+    whether it timed out or was throttled with a 429.
+
+    With a deadline, in seconds, the attempt in progress when it
+    passes is cancelled, and the job fails with a "DeadlineExceeded"
+    error instead of being retried.
+    '''
+
+    job_start = time.monotonic()
+
+    for n in range(max_attempts):
+
+        if breaker is not None and not breaker.allow(host):
+            return None, JobError("CircuitOpen", retry=False), n
+
+        if deadline is not None and time.monotonic() - job_start >= deadline:
+            return None, JobError("DeadlineExceeded", retry=False), n
+
+        if limit is not None:
+            await limit.acquire()
+
+        start = time.monotonic()
+        remaining = None if deadline is None else deadline - (start - job_start)
+
+        # The slot is given back whatever run_once() raises
+        try:
+            result = await asyncio.wait_for(run_once(), remaining)
+            error = None
+
+        except asyncio.TimeoutError:
+            # run_once() turns its own timeouts into JobErrors, so this is the deadline
+            return None, JobError("DeadlineExceeded", retry=False), n + 1
+
+        except JobError as e:
+            error = e
+
+        finally:
+            if limit is not None:
+                limit.release()
+
+        if error is None:
+            if limit is not None:
+                limit.record(time.monotonic() - start)
+
+            if breaker is not None:
+                breaker.success(host)
+
+            return result, None, n + 1
+
+        if limit is not None:
+            limit.record(None if error.status is None else time.monotonic() - start,
+                         congested=timed_out(error), throttled=error.status == 429)
+
+        if breaker is not None:
+            if unreachable(error):
+                breaker.failure(host)
+            else:
+                breaker.success(host)
+
+        if not error.retry or n == max_attempts - 1:
+            return None, error, n + 1
+
+        await asyncio.sleep(backoff(n))
+
+
+def connect(root=ROOT):
+    '''
+    Opens the ledger of a run, creating the table if needed,
+    and returns the sqlite3 connection. The connection can be
+    used from several threads, through the functions below.
+    '''
+
+    path = LEDGER_PATH.format(root=root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    conn = sqlite3.connect(path, check_same_thread=False)
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            stage TEXT NOT NULL,
+            search_query TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (stage, search_query, position)
+        )
+    ''')
+
+    return conn
+
+
+def add(conn, stage, jobs):
+    '''
+    Adds the (search_query, position) pairs of a stage
+    that are not in the ledger yet as pending.
+    '''
+
+    with lock:
+        conn.executemany("INSERT OR IGNORE INTO jobs (stage, search_query, position, state) VALUES (?, ?, ?, ?)",
+                         [(stage, search_query, int(position), PENDING) for search_query, position in jobs])
+        conn.commit()
+
+
+def track(conn, stage, jobs, retry_failed=False):
+    '''
+    Adds the jobs of a stage to the ledger and returns the
+    ones to run: all of them or, if `retry_failed`, only
+    the ones that failed before.
+
+    Params
+
+    conn: a connection returned by connect()
+    stage: one of DOWNLOAD, TITLE and VISION
+    jobs: a list of dictionaries with the keys search_query and position
+    retry_failed: whether to skip the jobs that never failed
+    '''
+
+    add(conn, stage, [(job["search_query"], job["position"]) for job in jobs])
+
+    if not retry_failed:
+        return jobs
+
+    failures = failed(conn, stage)
+
+    return [job for job in jobs if (job["search_query"], int(job["position"])) in failures]
+
+
+def record(conn, stage, search_query, position, error=None, attempts=1):
+    '''
+    Records the outcome of a job: done if `error` is None,
+    failed otherwise, adding `attempts` to its count.
+
+    Params
+
+    conn: a connection returned by connect()
+    stage: one of DOWNLOAD, THUMBNAIL, TITLE and VISION
+    search_query, position: the search result the job was for
+    error: the JobError, or the class of the error, the job failed with
+    attempts: the number of attempts made in this run
+    '''
+
+    state = DONE if error is None else FAILED
+    error = None if error is None else str(error)
+    updated_at = datetime.utcnow().isoformat(timespec="seconds")
+
+    with lock:
+        conn.execute("INSERT OR IGNORE INTO jobs (stage, search_query, position, state) VALUES (?, ?, ?, ?)",
+                     (stage, search_query, int(position), PENDING))
+        conn.execute('''
+            UPDATE jobs SET state = ?, attempts = attempts + ?, error = ?, updated_at = ?
+            WHERE stage = ? AND search_query = ? AND position = ?
+        ''', (state, attempts, error, updated_at, stage, search_query, int(position)))
+        conn.commit()
+
+
+def failed(conn, stage):
+    '''
+    Returns a set with the (search_query, position)
+    pairs of the failed jobs of a stage.
+    '''
+
+    with lock:
+        rows = conn.execute("SELECT search_query, position FROM jobs WHERE stage = ? AND state = ?",
+                            (stage, FAILED)).fetchall()
+
+    return set(rows)
+
+
+def summary(conn):
+    '''
+    Returns the number of jobs of each stage and state, and of
+    the failed jobs of each stage by error, as two lists of rows.
+    '''
+
+    with lock:
+        states = conn.execute("SELECT stage, state, COUNT(*) FROM jobs GROUP BY stage, state "
+                              "ORDER BY stage, state").fetchall()
+        errors = conn.execute("SELECT stage, error, COUNT(*) AS n FROM jobs WHERE state = ? "
+                              "GROUP BY stage, error ORDER BY stage, n DESC", (FAILED,)).fetchall()
+
+    return states, errors
+
+
+def main():
+
+    run = runs.parse_args("Prints a summary of the job ledger of a run")
+
+    conn = connect(run["root"])
+    states, errors = summary(conn)
+    conn.close()
+
+    for stage, state, n in states:
+        print(f"{stage:>10} {state:>8} {n:>7}")
+
+    if errors:
+        print("\nFailed jobs by error:")
+
+    for stage, error, n in errors:
+        print(f"{stage:>10} {n:>7} {error}")
+
+
+if __name__ == "__main__":
+    main()
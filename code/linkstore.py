@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Link contents store.
+#
+# Every title fetch made by 3.full-title-extraction.py is recorded in a single
+# SQLite table per run, keyed by search query and position, with the URL that
+# was requested, the URL it ended up at after redirects, the HTTP status, the
+# title and the time of the fetch. It replaces the one-line JSON file that was
+# saved for each title, and 4.aggregate-raw-data.py reads it in one query.
+#
+# Runs from before the store saved a one-line JSON file per title, under
+# link_contents/<query>/. Those files are recorded in the store, without
+# fetching anything, the first time step 3 or step 4 reads the query.
+#
+# Like the download manifest, successful fetches are also recorded by URL in
+# a table shared by all runs (see runs.py), so a page that another query or
+# run already fetched is not fetched again. The URLs are normalized first, so
+# that trivial differences like the case of the host name, a fragment or a
+# tracking parameter don't count as different pages, and entries older than
+# a configurable time to live are fetched again. Those fetches are conditional
+# requests with the ETag and Last-Modified headers of the last response, and
+# the stored title is kept if the server says the page didn't change.
+
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import pandas as pd
+
+
+ROOT = "../output"
+
+STORE_PATH = "{root}/dataset/link-contents.sqlite"
+
+# Shared by all runs
+URL_INDEX_PATH = f"{ROOT}/link_contents/urls.sqlite"
+
+COLUMNS = ["search_query", "position", "url", "final_url", "status", "title", "fetched_at",
+           "etag", "last_modified"]
+
+# Columns of the URL index, which has one entry per normalized URL
+URL_COLUMNS = COLUMNS[2:]
+
+# Days a title in the URL index can be reused by other queries and runs
+TTL_DAYS = 90
+
+# Query parameters that identify the visitor and not the page
+TRACKING_PARAMETERS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid")
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def url_key(url):
+    '''
+    Normalizes a URL into the key of the URL index: lowercase
+    scheme and host, no default port, no fragment, no tracking
+    parameters and the rest of the query parameters sorted.
+    '''
+
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except (AttributeError, ValueError):
+        return url
+
+    scheme = parts.scheme.lower()
+
+    netloc = (parts.hostname or "").lower()
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{port}"
+
+    query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if not name.lower().startswith(TRACKING_PARAMETERS))
+
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query), ""))
+
+
+def connect(root=ROOT):
+    '''
+    Opens the store of a run, creating the table if needed,
+    attaches the shared URL index and returns the sqlite3 connection.
+    '''
+
+    path = STORE_PATH.format(root=root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.makedirs(os.path.dirname(URL_INDEX_PATH), exist_ok=True)
+
+    conn = sqlite3.connect(path)
+    conn.create_function("url_key", 1, url_key)
+
+    # One writer, many small inserts: WAL makes each commit cheap
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS titles (
+            search_query TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            url TEXT,
+            final_url TEXT,
+            status INTEGER,
+            title TEXT,
+            fetched_at TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            PRIMARY KEY (search_query, position)
+        )
+    ''')
+
+    conn.execute("ATTACH DATABASE ? AS shared", (URL_INDEX_PATH,))
+    conn.execute("PRAGMA shared.journal_mode=WAL")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS shared.urls (
+            key TEXT PRIMARY KEY,
+            url TEXT,
+            final_url TEXT,
+            status INTEGER,
+            title TEXT,
+            fetched_at TEXT,
+            etag TEXT,
+            last_modified TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS shared.urls_url ON urls (url)")
+
+    # Titles recorded before the index existed are added to it
+    index_titles(conn)
+
+    return conn
+
+
+def index_titles(conn):
+    '''
+    Adds the successful fetches of the run that
+    are missing from the shared URL index. Only the
+    rows whose URL isn't in the index are normalized,
+    so opening a store doesn't scan it all again.
+    '''
+
+    conn.execute(f'''
+        INSERT OR IGNORE INTO shared.urls (key, {', '.join(URL_COLUMNS)})
+        SELECT url_key(url), {', '.join(URL_COLUMNS)} FROM titles
+        WHERE url IS NOT NULL AND status < 400
+        AND NOT EXISTS (SELECT 1 FROM shared.urls WHERE shared.urls.url = titles.url)
+    ''')
+    conn.commit()
+
+
+def record(conn, search_query, position, url, final_url=None, status=None, title=None,
+           etag=None, last_modified=None):
+    '''
+    Saves the outcome of a title fetch, replacing any previous
+    entry for the same query and position. A None status means
+    the page couldn't be reached.
+
+    Params
+
+    conn: a connection returned by connect()
+    search_query: the google image search string that retrieved this page
+    position: the position of the page in google search results
+    url: the url the page was requested from
+    final_url: the url of the page after redirects
+    status: the HTTP status code of the response
+    title: the text of the <title> tag, or None if there was none
+    etag, last_modified: the validators of the response, to check later if the page changed
+    '''
+
+    values = (search_query, int(position), url, final_url, status, title,
+              datetime.utcnow().isoformat(timespec="seconds"), etag, last_modified)
+
+    conn.execute(f"INSERT OR REPLACE INTO titles ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                 values)
+
+    if status is not None and status < 400:
+        conn.execute(f"INSERT OR REPLACE INTO shared.urls (key, {', '.join(URL_COLUMNS)}) VALUES (?, {', '.join('?' * len(URL_COLUMNS))})",
+                     (url_key(url),) + values[2:])
+
+    conn.commit()
+
+
+def lookup(conn, urls):
+    '''
+    Returns a dictionary with the entry of the URL index,
+    itself a dictionary, of each of the normalized URLs
+    that has one.
+    '''
+
+    cached = { }
+    keys = list({url_key(url) for url in urls})
+
+    # In chunks, to stay below SQLite's limit of parameters per query
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        rows = conn.execute(f"SELECT key, {', '.join(URL_COLUMNS)} FROM shared.urls WHERE key IN ({', '.join('?' * len(chunk))})",
+                            chunk)
+        cached.update((row[0], dict(zip(URL_COLUMNS, row[1:]))) for row in rows)
+
+    return cached
+
+
+def reuse(conn, jobs, ttl_days=TTL_DAYS):
+    '''
+    Copies the titles of the pages that were already fetched,
+    by this run or any other, less than `ttl_days` days ago, and
+    returns the (search_query, position) pairs that were copied.
+
+    Params
+
+    conn: a connection returned by connect()
+    jobs: a list of dictionaries with the keys search_query, position and url
+    ttl_days: how old a title can be to be reused
+    '''
+
+    cutoff = (datetime.utcnow() - timedelta(days=ttl_days)).isoformat(timespec="seconds")
+
+    cached = lookup(conn, [job["url"] for job in jobs])
+    fresh = {key for key, entry in cached.items() if (entry["fetched_at"] or "") >= cutoff}
+
+    linked = [(job["search_query"], int(job["position"]), job["url"], url_key(job["url"]))
+              for job in jobs if url_key(job["url"]) in fresh]
+
+    # The URL of each search result is kept as it was, the rest comes from the index
+    conn.executemany(f'''
+        INSERT OR REPLACE INTO titles ({', '.join(COLUMNS)})
+        SELECT ?, ?, ?, {', '.join(URL_COLUMNS[1:])} FROM shared.urls WHERE key = ?
+    ''', linked)
+    conn.commit()
+
+    return {(search_query, position) for search_query, position, url, key in linked}
+
+
+def backfill(conn, search_query, directory):
+    '''
+    Records the titles of a query that were saved as one JSON
+    file per position before the store existed, listing the
+    directory once, and adds them to the URL index. Returns
+    the positions that were found.
+    '''
+
+    rows = [ ]
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+
+            if not entry.name.endswith("-title-tag.json"):
+                continue
+
+            with open(entry.path) as f:
+                data = json.load(f)
+
+            fetched_at = datetime.utcfromtimestamp(entry.stat().st_mtime).isoformat(timespec="seconds")
+
+            rows.append((search_query, int(entry.name[:-len("-title-tag.json")]), data["url"],
+                         None, 200, data["title"], fetched_at, None, None))
+
+    conn.executemany(f"INSERT OR IGNORE INTO titles ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                     rows)
+
+    # Only the rows of this query are indexed, not the whole store again
+    conn.executemany(f"INSERT OR IGNORE INTO shared.urls (key, {', '.join(URL_COLUMNS)}) VALUES (?, {', '.join('?' * len(URL_COLUMNS))})",
+                     [(url_key(row[2]),) + row[2:] for row in rows if row[2] is not None])
+    conn.commit()
+
+    return [row[1] for row in rows]
+
+
+def backfill_queries(conn, search_queries, root=ROOT):
+    '''
+    Records the legacy title files of the queries that have
+    no entry in the store yet with backfill(), without fetching
+    anything, and returns a set with the (search_query, position)
+    pairs that were found.
+    '''
+
+    known = queries(conn)
+    found = set()
+
+    for search_query in search_queries:
+        directory = f"{root}/link_contents/{search_query.replace(' ', '-')}"
+        if search_query not in known and os.path.exists(directory):
+            found |= {(search_query, position) for position in backfill(conn, search_query, directory)}
+
+    return found
+
+
+def queries(conn):
+    '''
+    Returns a set with the search queries that have any entry in the store.
+    '''
+
+    return {row[0] for row in conn.execute("SELECT DISTINCT search_query FROM titles")}
+
+
+def completed(conn):
+    '''
+    Returns a set with the (search_query, position) pairs whose
+    page was fetched successfully, whether it had a title or not.
+    '''
+
+    rows = conn.execute("SELECT search_query, position FROM titles WHERE status < 400")
+
+    return set(rows)
+
+
+def read_titles(root=ROOT, search_queries=()):
+    '''
+    Reads the titles of a run into a dataframe with the
+    columns search_query, position and full_title. The
+    legacy title files of the given queries are recorded
+    first, so runs from before the store can be read
+    without running step 3 again.
+    '''
+
+    conn = connect(root)
+    try:
+        backfill_queries(conn, search_queries, root)
+        titles = pd.read_sql_query("SELECT search_query, position, title AS full_title FROM titles "
+                                   "WHERE title IS NOT NULL", conn)
+    finally:
+        conn.close()
+
+    # There is an entry with a \r in the title, which I have to remove
+    titles["full_title"] = titles.full_title.str.replace("\r", " ", regex=False)
+
+    return titles
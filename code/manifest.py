@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Download manifest.
+#
+# Every download attempt made by 2.image-download.py is recorded in a single
+# SQLite table, keyed by search query and position. Reruns use it to skip
+# the images that were already saved, and 4.aggregate-raw-data.py reads it
+# in one query instead of looking for each image file on disk. The sha256
+# column links each entry to its file in the content-addressed blob store,
+# and format, width and height describe the image, which was validated when
+# it was downloaded.
+#
+# Each run of the pipeline (see runs.py) has its own manifest. Successful
+# downloads are also recorded by URL in an index kept next to the blob store,
+# which is attached to every manifest, so an image that another run already
+# downloaded is linked to its blob instead of being fetched again. Entries
+# older than a configurable time to live are checked again with a conditional
+# request, using the ETag and Last-Modified headers of the last response, and
+# the stored blob is kept if the server says the image didn't change.
+#
+# The variant column tells if the stored image is the original or, when the
+# original couldn't be downloaded in time, the thumbnail of the search result.
+# Only originals go to the URL index, under the URL of the original. A result
+# with only a thumbnail is not complete, so later runs try the original again,
+# and a failed attempt at it keeps the thumbnail.
+
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import blobstore
+import imageinfo
+
+ROOT = "../output"
+
+MANIFEST_PATH = "{root}/dataset/download-manifest.sqlite"
+
+# Shared by all runs
+URL_INDEX_PATH = f"{blobstore.BLOB_DIR}/urls.sqlite"
+
+COLUMNS = ["search_query", "position", "url", "path",
+           "content_type", "bytes", "status", "fetched_at", "sha256",
+           "format", "width", "height", "etag", "last_modified", "variant"]
+
+# Variants of an image
+ORIGINAL, THUMBNAIL = "original", "thumbnail"
+
+# Columns of the URL index, which has one entry per URL
+URL_COLUMNS = COLUMNS[2:-1]
+
+# Days an image in the URL index is reused without asking the server
+TTL_DAYS = 90
+
+
+def connect(root=ROOT):
+    '''
+    Opens the manifest of a run, creating the table if needed,
+    attaches the shared URL index and returns the sqlite3 connection.
+    '''
+
+    path = MANIFEST_PATH.format(root=root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.makedirs(blobstore.BLOB_DIR, exist_ok=True)
+
+    conn = sqlite3.connect(path)
+
+    # One writer, many small inserts: WAL makes each commit cheap
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS downloads (
+            search_query TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            url TEXT,
+            path TEXT,
+            content_type TEXT,
+            bytes INTEGER,
+            status INTEGER,
+            fetched_at TEXT,
+            sha256 TEXT,
+            format TEXT,
+            width INTEGER,
+            height INTEGER,
+            etag TEXT,
+            last_modified TEXT,
+            variant TEXT DEFAULT 'original',
+            PRIMARY KEY (search_query, position)
+        )
+    ''')
+
+    conn.execute("ATTACH DATABASE ? AS shared", (URL_INDEX_PATH,))
+    conn.execute("PRAGMA shared.journal_mode=WAL")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS shared.urls (
+            url TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            content_type TEXT,
+            bytes INTEGER,
+            status INTEGER,
+            fetched_at TEXT,
+            sha256 TEXT,
+            format TEXT,
+            width INTEGER,
+            height INTEGER,
+            etag TEXT,
+            last_modified TEXT
+        )
+    ''')
+
+    # Downloads recorded before the index existed are added to it
+    conn.execute(f'''
+        INSERT OR IGNORE INTO shared.urls ({', '.join(URL_COLUMNS)})
+        SELECT {', '.join(URL_COLUMNS)} FROM downloads
+        WHERE url IS NOT NULL AND path IS NOT NULL AND variant = ?
+    ''', (ORIGINAL,))
+    conn.commit()
+
+    return conn
+
+
+def record(conn, search_query, position, url, path=None,
+           content_type=None, size=None, status=None, digest=None,
+           image_format=None, width=None, height=None, etag=None, last_modified=None, variant=ORIGINAL):
+    '''
+    Saves the outcome of a download attempt, replacing any
+    previous entry for the same query and position, unless
+    it failed and the entry is a stored thumbnail.
+    A None path means the attempt failed.
+
+    Params
+
+    conn: a connection returned by connect()
+    search_query: the google image search string that retrieved this image
+    position: the position of the image in google search results
+    url: the url of the original image in the search result
+    path: where the image was saved
+    content_type: the Content-Type header of the response
+    size: the number of bytes written
+    status: the HTTP status code of the response
+    digest: the SHA-256 hex digest of the image
+    image_format: the image format, e.g. "jpeg"
+    width, height: the image dimensions in pixels
+    etag, last_modified: the validators of the response, to check later if the image changed
+    variant: ORIGINAL, or THUMBNAIL if the image is the thumbnail of the search result
+    '''
+
+    values = (search_query, int(position), url, path, content_type, size, status,
+              datetime.utcnow().isoformat(timespec="seconds"), digest,
+              image_format, width, height, etag, last_modified, variant)
+
+    # A failure doesn't replace the thumbnail stored in place of the original
+    if path is None and conn.execute("SELECT 1 FROM downloads WHERE search_query = ? AND position = ? "
+                                     "AND variant = ? AND path IS NOT NULL",
+                                     (search_query, int(position), THUMBNAIL)).fetchone():
+        return
+
+    conn.execute(f"INSERT OR REPLACE INTO downloads ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                 values)
+
+    if path is not None and variant == ORIGINAL:
+        conn.execute(f"INSERT OR REPLACE INTO shared.urls ({', '.join(URL_COLUMNS)}) VALUES ({', '.join('?' * len(URL_COLUMNS))})",
+                     values[2:-1])
+
+    conn.commit()
+
+
+def lookup(conn, urls):
+    '''
+    Returns a dictionary with the entry of the URL index,
+    itself a dictionary, of each of the URLs that has one.
+    '''
+
+    cached = { }
+    urls = list(set(urls))
+
+    # In chunks, to stay below SQLite's limit of parameters per query
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i + 500]
+        rows = conn.execute(f"SELECT {', '.join(URL_COLUMNS)} FROM shared.urls WHERE url IN ({', '.join('?' * len(chunk))})", chunk)
+        cached.update((row[0], dict(zip(URL_COLUMNS, row))) for row in rows)
+
+    return cached
+
+
+def is_fresh(entry, ttl_days=TTL_DAYS):
+    '''
+    Checks if an entry of the URL index was
+    fetched less than `ttl_days` days ago.
+    '''
+
+    cutoff = (datetime.utcnow() - timedelta(days=ttl_days)).isoformat(timespec="seconds")
+
+    return (entry["fetched_at"] or "") >= cutoff
+
+
+def reuse(conn, jobs, ttl_days=TTL_DAYS):
+    '''
+    Links the images whose URL was already downloaded, by
+    this run or any other, less than `ttl_days` days ago,
+    to their blobs, and returns the (search_query, position)
+    pairs that were linked.
+
+    Params
+
+    conn: a connection returned by connect()
+    jobs: a list of dictionaries with the keys search_query, position and url
+    ttl_days: how old a download can be to be reused
+    '''
+
+    cached = lookup(conn, [job["url"] for job in jobs])
+
+    linked = [(job["search_query"], int(job["position"]), ORIGINAL, job["url"]) for job in jobs
+              if job["url"] in cached and is_fresh(cached[job["url"]], ttl_days)]
+
+    conn.executemany(f'''
+        INSERT OR REPLACE INTO downloads ({', '.join(COLUMNS)})
+        SELECT ?, ?, {', '.join(URL_COLUMNS)}, ? FROM shared.urls WHERE url = ?
+    ''', linked)
+    conn.commit()
+
+    return {(search_query, position) for search_query, position, variant, url in linked}
+
+
+def backfill(conn, search_query, directory):
+    '''
+    Records the images of a query that were downloaded before the manifest
+    existed, so they are not fetched again. The directory is scanned once
+    and each file is validated and hashed, so it can be matched with
+    identical blobs. Files that are not images are left out, so they are
+    downloaded again. Returns the positions that were found.
+    '''
+
+    positions = [ ]
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+
+            # Skips the temporary files of unfinished downloads, and anything that
+            # isn't named after a position, like subdirectories or stray files
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+
+            stem, _, extension = entry.name.partition(".")
+            try:
+                position = int(stem)
+            except ValueError:
+                continue
+
+            path = f"{directory}/{entry.name}"
+
+            try:
+                image_format, width, height = imageinfo.inspect(path)
+            except ValueError:
+                continue
+
+            positions.append(position)
+
+            conn.execute(f"INSERT OR IGNORE INTO downloads ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                         (search_query, position, None, path, f"image/{extension}",
+                          entry.stat().st_size, None, None, blobstore.hash_file(path),
+                          image_format, width, height, None, None, ORIGINAL))
+    conn.commit()
+
+    return positions
+
+
+def queries(conn):
+    '''
+    Returns a set with the search queries that have any entry in the manifest.
+    '''
+
+    return {row[0] for row in conn.execute("SELECT DISTINCT search_query FROM downloads")}
+
+
+def completed(conn):
+    '''
+    Returns a set with the (search_query, position) pairs
+    whose original image was downloaded successfully.
+    '''
+
+    rows = conn.execute("SELECT search_query, position FROM downloads WHERE path IS NOT NULL AND variant = ?",
+                        (ORIGINAL,))
+
+    return set(rows)
+
+
+def read_manifest(root=ROOT):
+    '''
+    Reads the whole manifest of a run into a pandas dataframe.
+    '''
+
+    conn = connect(root)
+    try:
+        return pd.read_sql_query(f"SELECT {', '.join(COLUMNS)} FROM downloads", conn)
+    finally:
+        conn.close()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Token bucket rate limiters and adaptive concurrency limits shared by the
+# workers of a pipeline stage.
+
+import asyncio
+import collections
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Hands out tokens at a fixed rate. Each call to acquire()
+    blocks until enough tokens are available. Up to `capacity`
+    tokens can accumulate while the bucket is idle, which
+    allows short bursts without exceeding the average rate.
+
+    Params
+
+    rate: tokens added per second
+    capacity: maximum number of tokens held. Defaults to one second worth of tokens.
+    '''
+
+    def __init__(self, rate, capacity=None):
+
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        '''
+        Takes `tokens` tokens from the bucket, sleeping
+        until they are available.
+        '''
+
+        if tokens > self.capacity:
+            raise ValueError(f"Can't acquire {tokens} tokens from a bucket of capacity {self.capacity}")
+
+        # The lock is held while sleeping, so callers are served in turn
+        with self.lock:
+            self.refill()
+
+            if self.tokens < tokens:
+                time.sleep((tokens - self.tokens) / self.rate)
+                self.refill()
+
+            self.tokens -= tokens
+
+
+class AsyncTokenBucket:
+    '''
+    asyncio version of TokenBucket, for stages that run
+    on an event loop. acquire() must be awaited.
+
+    Params
+
+    rate: tokens added per second
+    capacity: maximum number of tokens held. Defaults to one second worth of tokens.
+    '''
+
+    def __init__(self, rate, capacity=None):
+
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens=1):
+        '''
+        Takes `tokens` tokens from the bucket, waiting
+        until they are available.
+        '''
+
+        if tokens > self.capacity:
+            raise ValueError(f"Can't acquire {tokens} tokens from a bucket of capacity {self.capacity}")
+
+        # The lock is held while waiting, so callers are served in turn
+        async with self.lock:
+            self.refill()
+
+            if self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self.refill()
+
+            self.tokens -= tokens
+
+
+# Concurrency limits that adapt to the network and the API quota, like
+# TCP congestion control: additive increase, multiplicative decrease.
+
+# Requests added to the limit after a healthy window
+INCREASE = 1
+
+# Factor applied to the limit after a window with too many errors, or after throttling
+DECREASE = 0.5
+
+# Share of timeouts and throttled requests above which a window is not healthy
+MAX_ERROR_RATE = 0.1
+
+# A window slower than this many times the best window so far doesn't increase the limit
+LATENCY_TOLERANCE = 2.0
+
+
+class AIMD:
+    '''
+    Chooses how many requests a stage keeps in flight. Once every
+    `limit` completed requests, the limit grows by INCREASE if few
+    of them timed out or were throttled and they weren't much slower
+    than the best window so far, and it is multiplied by DECREASE if
+    too many of them failed that way. A request refused for throttling
+    or quota decreases it at once, at most once per window.
+
+    Params
+
+    name: the name of the stage, for the reports
+    initial: the limit to start with
+    maximum, minimum: bounds of the limit
+    '''
+
+    def __init__(self, name, initial, maximum, minimum=1):
+
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(maximum, initial))
+        self.peak = self.limit
+        self.best_latency = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        self.completed = 0
+        self.failed = 0
+        self.timed = 0
+        self.latency = 0.0
+        self.decreased = False
+
+    def set_limit(self, limit, reason=None):
+
+        limit = max(self.minimum, min(self.maximum, limit))
+
+        if limit < self.limit:
+            print(f"> {self.name}: {self.limit} -> {limit} in flight ({reason})")
+
+        self.limit = limit
+        self.peak = max(self.peak, limit)
+
+    def record(self, latency=None, congested=False, throttled=False):
+        '''
+        Reports a completed request.
+
+        Params
+
+        latency: seconds the request took, if it got an answer
+        congested: whether it timed out
+        throttled: whether it was refused for throttling or quota
+        '''
+
+        with self.lock:
+
+            self.completed += 1
+            self.failed += congested or throttled
+
+            if latency is not None:
+                self.timed += 1
+                self.latency += latency
+
+            if throttled and not self.decreased:
+                self.set_limit(int(self.limit * DECREASE), "throttled")
+                self.decreased = True
+
+            if self.completed >= self.limit:
+                self.adjust()
+
+    def adjust(self):
+
+        error_rate = self.failed / self.completed
+        latency = self.latency / self.timed if self.timed else None
+
+        if latency is not None and (self.best_latency is None or latency < self.best_latency):
+            self.best_latency = latency
+
+        if error_rate > MAX_ERROR_RATE:
+            if not self.decreased:
+                self.set_limit(int(self.limit * DECREASE), f"{error_rate:.0%} timeouts or throttled")
+        elif latency is None or latency <= LATENCY_TOLERANCE * self.best_latency:
+            self.set_limit(self.limit + INCREASE)
+
+        self.reset()
+
+    def report(self):
+
+        print(f"> {self.name}: finished with {self.limit} in flight, between {self.minimum} and {self.maximum}, "
+              f"and at most {self.peak}")
+
+
+class AdaptiveLimit(AIMD):
+    '''
+    AIMD limit for stages that run on threads. Each request
+    is wrapped in acquire() and release(), and reported
+    with record().
+    '''
+
+    def __init__(self, name, initial, maximum, minimum=1):
+
+        super().__init__(name, initial, maximum, minimum)
+        self.in_flight = 0
+        self.condition = threading.Condition(self.lock)
+
+    def set_limit(self, limit, reason=None):
+
+        super().set_limit(limit, reason)
+        self.condition.notify_all()
+
+    def acquire(self):
+        '''
+        Waits until there are fewer than `limit` requests in flight.
+        '''
+
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+class AsyncAdaptiveLimit(AIMD):
+    '''
+    asyncio version of AdaptiveLimit, for stages that
+    run on an event loop. acquire() must be awaited.
+    '''
+
+    def __init__(self, name, initial, maximum, minimum=1):
+
+        super().__init__(name, initial, maximum, minimum)
+        self.in_flight = 0
+        self.waiters = collections.deque()
+
+    def set_limit(self, limit, reason=None):
+
+        super().set_limit(limit, reason)
+        self.wake()
+
+    def wake(self):
+
+        free = self.limit - self.in_flight
+
+        while self.waiters and free > 0:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def acquire(self):
+        '''
+        Waits until there are fewer than `limit` requests in flight.
+        '''
+
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+
+        self.in_flight += 1
+
+    def release(self):
+
+        self.in_flight -= 1
+        self.wake()
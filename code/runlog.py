@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Structured run log of the network stages.
+#
+# Instead of one text file per error in <root>/logs, the outcome of every
+# search, download, title fetch and annotation is written as one line of JSON
+# to <root>/logs/run-log.jsonl: the stage, query, position, host, HTTP status,
+# seconds it took, attempts, error class and message, and bytes received.
+# Successes are logged too, so failure rates can be computed. The file is
+# rotated when it reaches MAX_BYTES, keeping BACKUP_COUNT older files.
+#
+# Running this file reads the log of a run, including the rotated files, and
+# prints the failure rates per stage and error, per host and per query:
+#
+#     python runlog.py [--language local] [--top 20]
+
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import pandas as pd
+
+import runs
+
+
+ROOT = "../output"
+
+LOG_PATH = "{root}/logs/run-log.jsonl"
+
+# Size of the log before it is rotated, and number of rotated files kept
+MAX_BYTES = 64 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# Rows shown per table of the summary
+TOP = 20
+
+
+def get(root=ROOT):
+    '''
+    Returns the logger that writes the run log of a root,
+    creating it the first time. Loggers can be shared by
+    threads and coroutines.
+    '''
+
+    path = LOG_PATH.format(root=root)
+
+    log = logging.getLogger(f"runlog:{os.path.abspath(path)}")
+
+    if not log.handlers:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT,
+                                                       encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        log.propagate = False
+
+    return log
+
+
+def event(log, stage, search_query, position, url=None, status=None, latency=None, attempts=1,
+          error=None, message=None, size=None):
+    '''
+    Writes the outcome of a job to the run log.
+
+    Params
+
+    log: a logger returned by get()
+    stage: the name of the stage, as in ledger.py
+    search_query, position: the search result the job was for, or the query and page of a search
+    url: the url requested, from which the host is taken
+    status: the HTTP status code of the response, if there was one
+    latency: seconds the job took, including retries
+    attempts: the number of attempts made
+    error: the class of the error the job failed with, or None if it succeeded
+    message: details of the error
+    size: bytes received
+    '''
+
+    record = {
+        "time": datetime.utcnow().isoformat(timespec="milliseconds"),
+        "stage": stage,
+        "query": search_query,
+        "position": int(position),
+        "host": urlsplit(url).netloc if url else None,
+        "status": status,
+        "latency": round(latency, 3) if latency is not None else None,
+        "attempts": attempts,
+        "error": None if error is None else str(error),
+        "message": message,
+        "bytes": size,
+    }
+
+    log.info(json.dumps(record, ensure_ascii=False))
+
+
+def read_log(root=ROOT):
+    '''
+    Reads the run log of a root, oldest events first, into
+    a dataframe with one row per event.
+    '''
+
+    path = LOG_PATH.format(root=root)
+    paths = [f"{path}.{n}" for n in range(BACKUP_COUNT, 0, -1)] + [path]
+
+    events = [ ]
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+
+    return pd.DataFrame(events, columns=["time", "stage", "query", "position", "host", "status", "latency",
+                                         "attempts", "error", "message", "bytes"])
+
+
+def failure_rates(outcomes, by):
+    '''
+    Counts the jobs and failures of each group, worst first.
+    '''
+
+    table = outcomes.groupby(by).agg(jobs=("failed", "size"), failures=("failed", "sum"),
+                                     attempts=("attempts", "sum"), latency=("latency", "median"))
+
+    table["failure_rate"] = (table.failures / table.jobs).round(3)
+
+    return table.sort_values(["failures", "failure_rate"], ascending=False)
+
+
+def summarize(events, top=TOP):
+    '''
+    Prints the failure rates per stage and error, per host and per
+    query. A job that was run several times, as when a failure is
+    retried in a later run, only counts with its last outcome.
+    '''
+
+    outcomes = events.drop_duplicates(subset=["stage", "query", "position"], keep="last")
+    outcomes = outcomes.assign(failed=outcomes.error.notna(), error=outcomes.error.fillna("-"),
+                               host=outcomes.host.fillna("-"))
+
+    print(f"{len(events)} events, {len(outcomes)} jobs\n")
+
+    print(failure_rates(outcomes, "stage").to_string(), "\n")
+
+    errors = outcomes[outcomes.failed].groupby(["stage", "error"]).size().rename("failures")
+    if not errors.empty:
+        print(errors.sort_values(ascending=False).to_string(), "\n")
+
+    print(failure_rates(outcomes[outcomes.host != "-"], ["stage", "host"]).head(top).to_string(), "\n")
+
+    print(failure_rates(outcomes, ["stage", "query"]).head(top).to_string())
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Summarizes the failures in the run log")
+    parser.add_argument("--top", type=int, default=TOP, help="rows shown for hosts and queries")
+    runs.add_arguments(parser)
+    args = parser.parse_args()
+
+    events = read_log(runs.from_args(args)["root"])
+
+    if events.empty:
+        print("The run log is empty")
+        return
+
+    summarize(events, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Languages and output roots of the pipeline.
+#
+# Steps 1 to 6 take a --language option, which chooses the nationalities
+# file, how a search query is written for each nationality and where the
+# outputs of the run are saved:
+#
+#     python 2.image-download.py --language local
+#
+# Each run keeps its own search results, manifest, titles, vision results
+# and datasets under its root, with the same layout as ../output. --root
+# points a step at another root, such as a sweep partition, whose input and
+# template are then the ones the sweep searched with. The caches that
+# don't depend on the query are shared by every run: the image blobs and
+# their URL index, the titles by URL and the vision results by image hash.
+# A run only downloads, fetches and annotates what no other run did before.
+
+import argparse
+
+import sweep
+
+
+LANGUAGES = {
+    "english": {
+        "input": "../input/nationalities.csv",
+        "template": "{adjectivals} women",
+        "root": "../output",
+    },
+    "local": {
+        "input": "../local_language/input/nationalities.csv",
+        "template": "{search_query}",
+        "root": "../local_language/output",
+    },
+}
+
+LANGUAGE = "english"
+
+
+def add_arguments(parser):
+    '''
+    Adds the --language and --root options to an argparse parser.
+    '''
+
+    parser.add_argument("--language", choices=sorted(LANGUAGES), default=LANGUAGE,
+                        help="which set of search queries to work on")
+    parser.add_argument("--root", help="output directory of the run, if not the language's default")
+
+
+def from_args(args):
+    '''
+    Returns the settings of the run chosen on the command
+    line, as a dictionary with the keys language, input,
+    template and root. The input and template of a sweep
+    partition come from its sweep.json file.
+    '''
+
+    run = dict(LANGUAGES[args.language], language=args.language)
+
+    if args.root:
+        run["root"] = args.root
+
+        partition = sweep.read_partition(args.root)
+        if partition:
+            run["input"], run["template"] = partition["input"], partition["template"]
+
+    return run
+
+
+def parse_args(description):
+    '''
+    Command line parser of the steps that take
+    no options besides the run.
+    '''
+
+    parser = argparse.ArgumentParser(description=description)
+    add_arguments(parser)
+
+    return from_args(parser.parse_args())
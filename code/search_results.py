@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Search results loader shared by steps 2, 3 and 4.
+#
+# The SerpAPI JSON files are parsed into a single table with one row per
+# image result and the columns search_query, position, original, link,
+# title, source and thumbnail. The table is cached as Parquet next to an
+# index with the modification time and size of every JSON file, so the
+# files are only parsed again when they change. Each run of the pipeline
+# (see runs.py) has its own search results and cache under its root.
+#
+# Some countries share a demonym, like Congo and DR Congo, so their files
+# hold the same search. Each query and position is only listed once.
+
+import glob
+import json
+import os
+
+import pandas as pd
+
+
+ROOT = "../output"
+
+PATTERN = "{root}/search_results/*.json"
+CACHE_PATH = "{root}/dataset/search-results.parquet"
+
+COLUMNS = ["search_query", "position", "original", "link", "title", "source", "thumbnail"]
+
+
+def fingerprint(fpath):
+    '''
+    Identifies the current version of a file
+    by its modification time and size.
+    '''
+
+    stat = os.stat(fpath)
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def parse_file(fpath):
+    '''
+    Reads a SerpAPI JSON file into a dataframe with
+    one row per image result. Files saved for failed
+    searches, or for pages past the last result, give
+    an empty dataframe.
+    '''
+
+    with open(fpath) as f:
+        data = json.load(f)
+
+    if "images_results" not in data:
+        print(f"No image results in {fpath}")
+
+    # Pages past the last result of a search are saved empty
+    if not data.get("images_results"):
+        return pd.DataFrame(columns=COLUMNS + ["file"])
+
+    df = pd.DataFrame(data["images_results"]).reindex(columns=COLUMNS)
+    df["search_query"] = data["search_parameters"]["q"]
+    df["file"] = fpath
+
+    return df
+
+
+def unique_results(table):
+    '''
+    Drops the file column, and the results of a query and
+    position that were also saved in another file.
+    '''
+
+    table = table.drop_duplicates(subset=["search_query", "position"], keep="last")
+
+    return table.drop(columns="file").reset_index(drop=True)
+
+
+def load(root=ROOT):
+    '''
+    Returns the table of search results, parsing only
+    the JSON files that are new or changed since the
+    cache was last written.
+
+    Params
+
+    root: the output directory of the run
+    '''
+
+    pattern = PATTERN.format(root=root)
+    cache_path = CACHE_PATH.format(root=root)
+    index_path = f"{cache_path}.index.json"
+
+    current = {fpath: fingerprint(fpath) for fpath in glob.glob(pattern)}
+
+    cached, table = { }, None
+    if os.path.exists(cache_path) and os.path.exists(index_path):
+        with open(index_path) as f:
+            cached = json.load(f)
+        table = pd.read_parquet(cache_path)
+
+    changed = [fpath for fpath, stamp in current.items() if cached.get(fpath) != stamp]
+
+    if table is not None and not changed and cached.keys() == current.keys():
+        return unique_results(table)
+
+    # Keeps the rows of the unchanged files and parses the rest again
+    tables = [ ]
+    if table is not None:
+        tables.append(table[table.file.isin(current.keys()) & ~table.file.isin(changed)])
+
+    print(f"Parsing {len(changed)} search result files")
+    tables.extend(parse_file(fpath) for fpath in changed)
+
+    if not tables:
+        return pd.DataFrame(columns=COLUMNS)
+
+    table = pd.concat(tables, ignore_index=True)
+    table["position"] = table["position"].astype(int)
+    table = table.sort_values(["file", "position"]).reset_index(drop=True)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    table.to_parquet(cache_path, index=False)
+    with open(index_path, "w") as f:
+        json.dump(current, f)
+
+    return unique_results(table)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Query sweeps for 1.data-collection.py.
+#
+# A sweep is described by a JSON file, such as the ones in input/sweeps/:
+#
+#     {
+#         "input": "../input/nationalities.csv",
+#         "name": "{country}",
+#         "templates": ["{adjectivals} women"],
+#         "locales": [{ }, {"gl": "br", "hl": "pt", "location": "Brazil"}],
+#         "repetitions": 3
+#     }
+#
+# Every row of the input CSV is rendered with every template, and every
+# query is searched with every set of SerpAPI locale parameters, as many
+# times as there are repetitions. Each combination of template, locale and
+# repetition is a partition of the results, stored as its own output root:
+#
+#     ../output/sweeps/<template>/<locale>/run-<n>/search_results/<name>.json
+#
+# Since partitions don't depend on the sweep that asked for them, sweeps that
+# overlap share their results instead of searching again. Each partition also
+# keeps the template, input and locale it was searched with in a sweep.json
+# file, which the later steps read when they are pointed at it with --root.
+#
+# Sweep searches ask SerpAPI not to answer from its cache, which would return
+# the same results to every repetition of a search.
+
+import json
+import os
+import re
+
+import pandas as pd
+
+
+SWEEP_ROOT = "../output/sweeps"
+
+PARTITION_PATH = "{root}/sweep.json"
+
+# Parameters sent to SerpAPI with every search
+BASE_PARAMS = {"engine": "google", "tbm": "isch"}
+
+# Parameters added to the searches of a sweep, so that repetitions aren't copies
+SWEEP_PARAMS = {"no_cache": "true"}
+
+# SerpAPI parameters that can vary between locales
+LOCALE_KEYS = ["gl", "hl", "location"]
+
+
+def slugify(text):
+
+    return re.sub(r"[^\w]+", "-", text.lower(), flags=re.UNICODE).strip("-")
+
+
+def locale_key(locale):
+    '''
+    Names the directory of a set of locale
+    parameters, such as gl-br_hl-pt_location-brazil.
+    An empty locale is called "default".
+    '''
+
+    if not locale:
+        return "default"
+
+    return "_".join(f"{key}-{slugify(str(locale[key]))}" for key in sorted(locale))
+
+
+def partition_root(template, locale, run, sweep_root=SWEEP_ROOT):
+
+    return f"{sweep_root}/{slugify(template)}/{locale_key(locale)}/run-{run}"
+
+
+def read_spec(path):
+    '''
+    Reads a sweep specification, filling in the defaults:
+    a single empty locale and a single repetition.
+    '''
+
+    with open(path) as f:
+        spec = json.load(f)
+
+    spec.setdefault("locales", [{ }])
+    spec.setdefault("repetitions", 1)
+
+    for locale in spec["locales"]:
+        unknown = set(locale) - set(LOCALE_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown locale parameters {sorted(unknown)} in {path}")
+
+    return spec
+
+
+def plan(spec, api_key, sweep_root=SWEEP_ROOT):
+    '''
+    Expands a sweep into the list of jobs expected by
+    collector.run(). Queries that several rows render
+    to the same text, within the same partition, are
+    searched only once.
+
+    Params
+
+    spec: a sweep specification, as returned by read_spec()
+    api_key: the SerpAPI key
+    sweep_root: the directory that holds all the partitions
+    '''
+
+    rows = pd.read_csv(spec["input"]).to_dict("records")
+
+    jobs, seen = [ ], set()
+
+    for root, partition in partitions(spec, sweep_root).items():
+        for row in rows:
+
+            query = partition["template"].format(**row)
+
+            if (root, query.lower()) in seen:
+                continue
+            seen.add((root, query.lower()))
+
+            jobs.append({"q": query,
+                         "params": dict(BASE_PARAMS, api_key=api_key, **SWEEP_PARAMS, **partition["locale"]),
+                         "name": spec["name"].format(**row),
+                         "root": root})
+
+    return jobs
+
+
+def partitions(spec, sweep_root=SWEEP_ROOT):
+    '''
+    Returns a dictionary with the description of every
+    partition of a sweep, by its root: the input, template,
+    locale and repetition it is searched with.
+    '''
+
+    return {partition_root(template, locale, run, sweep_root): {"input": spec["input"], "template": template,
+                                                                 "locale": locale, "run": run}
+            for template in spec["templates"]
+            for locale in spec["locales"]
+            for run in range(1, spec["repetitions"] + 1)}
+
+
+def save_partitions(spec, sweep_root=SWEEP_ROOT):
+    '''
+    Writes the description of every partition
+    of a sweep to the sweep.json file of its root.
+    '''
+
+    for root, partition in partitions(spec, sweep_root).items():
+        os.makedirs(root, exist_ok=True)
+        with open(PARTITION_PATH.format(root=root), "w") as f:
+            json.dump(partition, f, indent=4)
+
+
+def read_partition(root):
+    '''
+    Returns the description saved by save_partitions()
+    in an output root, or None if it isn't a partition.
+    '''
+
+    try:
+        with open(PARTITION_PATH.format(root=root)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,6 @@
+# The pipeline modules are imported directly from code/, as the steps do
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+import pytest
+
+import annotation
+import ledger
+import runlog
+
+
+class BrokenAnnotator:
+
+    def annotate(self, contents):
+        raise RuntimeError("bug in the backend")
+
+
+class EmptyAnnotator:
+
+    def __init__(self):
+        self.sent = [ ]
+
+    def annotate(self, contents):
+        self.sent.append(contents)
+        return [{"label_annotations": [ ], "safe_search_annotations": { }} for content in contents]
+
+
+def test_stream_annotates_every_new_image_once(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(annotation, "HASH_DIR", f"{tmp_path}/by_hash/")
+
+    annotator = EmptyAnnotator()
+    stream = annotation.AnnotationStream(annotator, str(tmp_path), ledger.connect(str(tmp_path)),
+                                         n_workers=2, queue_size=4)
+
+    async def main():
+        stream.start()
+        for position in range(10):
+            path = tmp_path / f"{position}.jpg"
+            path.write_bytes(b"image")
+            await asyncio.wait_for(stream.put("query", position, str(path), f"digest{position}", 5), 5)
+
+        # An image that another query returned is not sent again
+        await stream.put("other query", 1, str(tmp_path / "1.jpg"), "digest1", 5)
+        await asyncio.wait_for(stream.close(), 5)
+
+    asyncio.new_event_loop().run_until_complete(main())
+
+    assert sum(len(contents) for contents in annotator.sent) == 10
+    assert sorted(os.listdir(f"{tmp_path}/by_hash")) == sorted(f"digest{n}.json" for n in range(10))
+
+
+def test_annotate_batch_gives_the_slot_back_on_unexpected_errors(tmp_path):
+
+    path = tmp_path / "image.jpg"
+    path.write_bytes(b"image")
+    batch = [annotation.Image("query", 1, str(path), "digest", 5)]
+
+    limit = annotation.make_limit(1)
+    conn = ledger.connect(str(tmp_path))
+
+    with pytest.raises(RuntimeError):
+        annotation.annotate_batch(batch, annotation.make_bucket(), limit, BrokenAnnotator(),
+                                  conn, runlog.get(str(tmp_path)))
+
+    assert limit.in_flight == 0
+
+
+def test_annotate_batch_records_missing_images_and_sends_the_rest(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(annotation, "HASH_DIR", f"{tmp_path}/")
+
+    path = tmp_path / "image.jpg"
+    path.write_bytes(b"image")
+    batch = [annotation.Image("query", 1, str(tmp_path / "missing.jpg"), "missing", 5),
+             annotation.Image("query", 2, str(path), "digest", 5)]
+
+    annotator = EmptyAnnotator()
+    conn = ledger.connect(str(tmp_path))
+
+    annotation.annotate_batch(batch, annotation.make_bucket(), annotation.make_limit(1), annotator,
+                              conn, runlog.get(str(tmp_path)))
+
+    assert annotator.sent == [[b"image"]]
+    assert ledger.failed(conn, ledger.VISION) == {("query", 1)}
+    assert (tmp_path / "digest.json").exists()
+
+
+def test_stream_keeps_consuming_after_unexpected_errors(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(annotation, "HASH_DIR", f"{tmp_path}/by_hash/")
+
+    conn = ledger.connect(str(tmp_path))
+    stream = annotation.AnnotationStream(BrokenAnnotator(), str(tmp_path), conn, n_workers=2, queue_size=4)
+
+    async def main():
+        stream.start()
+        for position in range(10):
+            path = tmp_path / f"{position}.jpg"
+            path.write_bytes(b"image")
+            await asyncio.wait_for(stream.put("query", position, str(path), f"digest{position}", 5), 5)
+        await asyncio.wait_for(stream.close(), 5)
+
+    asyncio.new_event_loop().run_until_complete(main())
+
+    assert len(ledger.failed(conn, ledger.VISION)) == 10
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+import collector
+
+
+class FakeResponse:
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self, content_type=None):
+        if isinstance(self.body, str):
+            raise ValueError("not JSON")
+        return self.body
+
+
+class FakeSession:
+
+    def __init__(self, status, body):
+        self.response = FakeResponse(status, body)
+
+    def get(self, endpoint, params=None):
+        return self.response
+
+
+def search(status, body):
+
+    return asyncio.new_event_loop().run_until_complete(collector.search(FakeSession(status, body), { }, "x"))
+
+
+@pytest.mark.parametrize("status, body, retry", [
+    (429, "Too Many Requests", True),
+    (503, "<html>Service Unavailable</html>", True),
+    (200, "truncated {", True),
+    (401, {"error": "Invalid API key"}, False),
+    (403, "<html>Forbidden</html>", False),
+    (404, "Not Found", False),
+])
+def test_search_retries_only_throttling_and_server_errors(status, body, retry):
+
+    with pytest.raises(collector.SearchError) as e:
+        search(status, body)
+
+    assert e.value.retry == retry
+
+
+def test_search_returns_the_results():
+
+    assert search(200, {"images_results": [{"position": 1}]}) == {"images_results": [{"position": 1}]}
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import ledger
+from ratelimit import AsyncAdaptiveLimit
+import workqueue
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+
+    monkeypatch.setattr(ledger, "backoff", lambda attempt: 0)
+
+
+def attempt(run_once, **kwargs):
+
+    return asyncio.new_event_loop().run_until_complete(ledger.attempt(run_once, **kwargs))
+
+
+def test_attempt_retries_errors_worth_retrying():
+
+    calls = [ ]
+
+    async def run_once():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ledger.http_error(503)
+        return "ok"
+
+    assert attempt(run_once) == ("ok", None, 3)
+
+
+def test_attempt_stops_on_errors_not_worth_retrying():
+
+    async def run_once():
+        raise ledger.http_error(404)
+
+    result, error, attempts = attempt(run_once)
+
+    assert result is None and str(error) == "HTTP 404" and attempts == 1
+
+
+def test_attempt_reports_unreachable_hosts_to_the_breaker():
+
+    breaker = workqueue.CircuitBreaker(trip_after=2, cooldown=60)
+
+    async def run_once():
+        raise ledger.JobError("ClientConnectorError", retry=True)
+
+    result, error, attempts = attempt(run_once, breaker=breaker, host="a")
+
+    assert str(error) == "CircuitOpen" and attempts == 2
+
+
+def test_attempt_fails_at_the_deadline():
+
+    async def run_once():
+        await asyncio.sleep(10)
+
+    result, error, attempts = attempt(run_once, deadline=0.05)
+
+    assert str(error) == "DeadlineExceeded" and attempts == 1
+
+
+@pytest.mark.parametrize("exception", [ledger.http_error(404), RuntimeError("bug"), asyncio.TimeoutError()])
+def test_attempt_always_gives_the_slot_back(exception):
+
+    loop = asyncio.new_event_loop()
+    limit = AsyncAdaptiveLimit("test", initial=1, maximum=1)
+
+    async def run_once():
+        raise exception
+
+    try:
+        loop.run_until_complete(ledger.attempt(run_once, limit=limit, deadline=10))
+    except RuntimeError:
+        pass
+
+    assert limit.in_flight == 0
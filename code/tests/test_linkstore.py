@@ -0,0 +1,40 @@
+import pytest
+
+import linkstore
+
+
+def test_url_key_ignores_trivial_differences():
+
+    assert linkstore.url_key("HTTP://Example.com:80/a?b=2&utm_source=x&a=1#top") == "http://example.com/a?a=1&b=2"
+    assert linkstore.url_key("https://example.com") == "https://example.com/"
+    assert linkstore.url_key("https://example.com:8443/a") == "https://example.com:8443/a"
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(linkstore, "URL_INDEX_PATH", str(tmp_path / "urls.sqlite"))
+    conn = linkstore.connect(str(tmp_path))
+    yield conn
+    conn.close()
+
+
+def test_connect_indexes_only_the_titles_missing_from_the_index(conn, tmp_path, monkeypatch):
+
+    conn.execute("INSERT INTO titles (search_query, position, url, status, title) "
+                 "VALUES ('q', 1, 'http://Example.com/a#top', 200, 'A')")
+    conn.commit()
+    conn.close()
+
+    keyed = [ ]
+    url_key = linkstore.url_key
+    monkeypatch.setattr(linkstore, "url_key", lambda url: keyed.append(url) or url_key(url))
+
+    conn = linkstore.connect(str(tmp_path))
+    assert keyed == ["http://Example.com/a#top"]
+    assert list(linkstore.lookup(conn, ["http://example.com/a"])) == ["http://example.com/a"]
+    conn.close()
+
+    keyed.clear()
+    linkstore.connect(str(tmp_path)).close()
+    assert keyed == [ ]
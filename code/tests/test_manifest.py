@@ -0,0 +1,43 @@
+import pytest
+from PIL import Image
+
+import manifest
+
+
+@pytest.fixture
+def imgs(tmp_path, monkeypatch):
+
+    # The steps run from code/ and write to ../output
+    (tmp_path / "code").mkdir()
+    (tmp_path / "output" / "dataset").mkdir(parents=True)
+    monkeypatch.chdir(tmp_path / "code")
+
+    directory = tmp_path / "output" / "imgs" / "brazilian-women"
+    directory.mkdir(parents=True)
+
+    return directory
+
+
+def test_backfill_records_the_images_downloaded_before_the_manifest(imgs):
+
+    Image.new("RGB", (4, 3)).save(imgs / "1.png")
+    Image.new("RGB", (4, 3)).save(imgs / "2.jpg")
+
+    conn = manifest.connect()
+
+    assert sorted(manifest.backfill(conn, "brazilian women", str(imgs))) == [1, 2]
+    assert manifest.completed(conn) == {("brazilian women", 1), ("brazilian women", 2)}
+
+
+def test_backfill_skips_entries_not_named_after_a_position(imgs):
+
+    Image.new("RGB", (4, 3)).save(imgs / "1.png")
+    Image.new("RGB", (4, 3)).save(imgs / "cover.png")
+    (imgs / ".DS_Store").write_bytes(b"\0")
+    (imgs / "README").write_text("notes")
+    (imgs / "2.png").mkdir()
+
+    conn = manifest.connect()
+
+    assert manifest.backfill(conn, "brazilian women", str(imgs)) == [1]
+    assert conn.execute("SELECT position, format, width, height FROM downloads").fetchall() == [(1, "png", 4, 3)]
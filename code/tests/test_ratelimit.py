@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+from ratelimit import AIMD, AdaptiveLimit, AsyncAdaptiveLimit
+
+
+def test_aimd_increases_after_a_healthy_window():
+
+    limit = AIMD("test", initial=4, maximum=8)
+
+    for _ in range(4):
+        limit.record(0.1)
+
+    assert limit.limit == 5
+
+
+def test_aimd_halves_after_too_many_timeouts():
+
+    limit = AIMD("test", initial=8, maximum=8)
+
+    for n in range(8):
+        limit.record(congested=n < 2)
+
+    assert limit.limit == 4
+
+
+def test_aimd_halves_once_per_window_when_throttled():
+
+    limit = AIMD("test", initial=8, maximum=8)
+
+    limit.record(throttled=True)
+    limit.record(throttled=True)
+
+    assert limit.limit == 4
+
+
+def test_aimd_stays_within_bounds():
+
+    limit = AIMD("test", initial=2, maximum=3, minimum=2)
+
+    for _ in range(10):
+        limit.record(throttled=True)
+        limit.reset()
+    assert limit.limit == 2
+
+    for _ in range(20):
+        limit.record(0.1)
+    assert limit.limit == 3
+
+
+def test_adaptive_limit_blocks_at_the_limit():
+
+    limit = AdaptiveLimit("test", initial=1, maximum=1)
+    limit.acquire()
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limit.acquire(), acquired.set()))
+    thread.start()
+
+    assert not acquired.wait(0.1)
+
+    limit.release()
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_async_adaptive_limit_wakes_waiters_when_it_grows():
+
+    limit = AsyncAdaptiveLimit("test", initial=1, maximum=2)
+
+    async def main():
+        await limit.acquire()
+        waiter = asyncio.ensure_future(limit.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        limit.set_limit(2)
+        await asyncio.wait_for(waiter, 1)
+        assert limit.in_flight == 2
+
+    asyncio.new_event_loop().run_until_complete(main())
@@ -0,0 +1,50 @@
+import json
+
+import search_results
+
+
+def write_results(path, search_query, originals):
+
+    results = [{"position": n + 1, "original": original} for n, original in enumerate(originals)]
+
+    with open(path, "w") as f:
+        json.dump({"search_parameters": {"q": search_query}, "images_results": results}, f)
+
+
+def test_load_parses_only_the_files_that_changed(tmp_path, monkeypatch):
+
+    (tmp_path / "code").mkdir()
+    (tmp_path / "output" / "search_results").mkdir(parents=True)
+    (tmp_path / "output" / "dataset").mkdir()
+    monkeypatch.chdir(tmp_path / "code")
+
+    write_results("../output/search_results/brazil.json", "brazilian women", ["a", "b"])
+    write_results("../output/search_results/chile.json", "chilean women", ["c"])
+    assert len(search_results.load()) == 3
+
+    parsed = [ ]
+    parse_file = search_results.parse_file
+    monkeypatch.setattr(search_results, "parse_file", lambda fpath: parsed.append(fpath) or parse_file(fpath))
+
+    write_results("../output/search_results/chile.json", "chilean women", ["c", "d"])
+    table = search_results.load()
+
+    assert parsed == ["../output/search_results/chile.json"]
+    assert sorted(zip(table.search_query, table.position)) == [("brazilian women", 1), ("brazilian women", 2),
+                                                                ("chilean women", 1), ("chilean women", 2)]
+
+
+def test_load_lists_each_query_and_position_once(tmp_path):
+
+    (tmp_path / "search_results").mkdir()
+
+    # Congo and DR Congo both search for "congolese women"
+    write_results(tmp_path / "search_results" / "congo.json", "congolese women", ["a", "b"])
+    write_results(tmp_path / "search_results" / "dr-congo.json", "congolese women", ["a", "b"])
+    write_results(tmp_path / "search_results" / "brazil.json", "brazilian women", ["c"])
+
+    for _ in range(2):
+        table = search_results.load(str(tmp_path))
+
+        assert sorted(zip(table.search_query, table.position)) == [("brazilian women", 1), ("congolese women", 1),
+                                                                    ("congolese women", 2)]
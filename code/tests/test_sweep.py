@@ -0,0 +1,56 @@
+import argparse
+
+import runs
+import sweep
+
+
+def make_spec(tmp_path):
+
+    # Congo and DR Congo render to the same query
+    path = tmp_path / "nationalities.csv"
+    path.write_text("country,adjectivals\nbrazil,Brazilian\ncongo,Congolese\ndr-congo,Congolese\n")
+
+    return {"input": str(path), "name": "{country}", "templates": ["{adjectivals} girls"],
+            "locales": [{ }, {"gl": "br"}], "repetitions": 2}
+
+
+def test_plan_searches_each_query_once_per_partition(tmp_path):
+
+    jobs = sweep.plan(make_spec(tmp_path), "key", str(tmp_path / "sweeps"))
+
+    assert len(jobs) == 8
+    assert {job["root"] for job in jobs} == {sweep.partition_root("{adjectivals} girls", locale, run,
+                                                                  str(tmp_path / "sweeps"))
+                                             for locale in [{ }, {"gl": "br"}] for run in (1, 2)}
+    assert sorted(job["q"] for job in jobs if job["root"].endswith("gl-br/run-2")) == ["Brazilian girls",
+                                                                                       "Congolese girls"]
+    assert all(job["params"].get("gl") == "br" for job in jobs if "/gl-br/" in job["root"])
+
+
+def test_plan_asks_serpapi_not_to_answer_from_its_cache(tmp_path):
+
+    jobs = sweep.plan(make_spec(tmp_path), "key", str(tmp_path / "sweeps"))
+
+    assert all(job["params"]["no_cache"] == "true" for job in jobs)
+    assert {job["root"] for job in jobs} == set(sweep.partitions(make_spec(tmp_path), str(tmp_path / "sweeps")))
+
+
+def test_runs_of_a_partition_use_the_template_of_the_sweep(tmp_path):
+
+    spec = make_spec(tmp_path)
+    sweep.save_partitions(spec, str(tmp_path / "sweeps"))
+    root = sweep.partition_root("{adjectivals} girls", {"gl": "br"}, 2, str(tmp_path / "sweeps"))
+
+    run = runs.from_args(argparse.Namespace(language="english", root=root))
+
+    assert run["template"] == "{adjectivals} girls"
+    assert run["input"] == spec["input"]
+    assert sweep.read_partition(root)["locale"] == {"gl": "br"}
+
+
+def test_runs_of_other_roots_keep_the_language_template(tmp_path):
+
+    run = runs.from_args(argparse.Namespace(language="local", root=str(tmp_path)))
+
+    assert run["template"] == runs.LANGUAGES["local"]["template"]
+    assert run["root"] == str(tmp_path)
@@ -0,0 +1,66 @@
+import json
+
+import pandas as pd
+
+import vision_table
+
+
+def write_result(directory, search_query, position, racy):
+
+    annotations = {
+        "search_query": search_query,
+        "position": position,
+        "label_annotations": [{"description": "person", "score": 0.9}],
+        "safe_search_annotations": {category: {"likelihood": "UNLIKELY"}
+                                    for category in vision_table.SAFE_SEARCH_CATEGORIES},
+    }
+    annotations["safe_search_annotations"]["racy"]["likelihood"] = racy
+
+    with open(f"{directory}/{search_query}-{position}.json", "w") as f:
+        json.dump(annotations, f)
+
+    return annotations
+
+
+def test_read_table_builds_the_table_from_the_result_files(tmp_path, monkeypatch):
+
+    (tmp_path / "code").mkdir()
+    (tmp_path / "output" / "vision_results").mkdir(parents=True)
+    (tmp_path / "output" / "dataset").mkdir()
+    monkeypatch.chdir(tmp_path / "code")
+
+    write_result("../output/vision_results", "brazilian-women", 1, "LIKELY")
+    write_result("../output/vision_results", "brazilian-women", 2, "VERY_UNLIKELY")
+
+    table = vision_table.read_table()
+
+    assert sorted(zip(table.query_key, table.position)) == [("brazilian-women", 1), ("brazilian-women", 2)]
+    assert table.racy.max() == "LIKELY"
+    assert len(table.labels.iloc[0]) == 1
+
+
+def test_update_table_keeps_results_whose_images_are_not_on_disk(tmp_path):
+
+    root = str(tmp_path)
+    (tmp_path / "dataset").mkdir()
+    (tmp_path / "vision_results").mkdir()
+    (tmp_path / "by_hash").mkdir()
+
+    write_result(f"{root}/vision_results", "brazilian-women", 1, "LIKELY")
+
+    # No image of the run was downloaded on this computer
+    df = pd.DataFrame(columns=["search_query", "position", "img_sha256"])
+
+    table = vision_table.update_table(df, root, hash_dir=f"{root}/by_hash/")
+    assert len(table) == 1
+
+    # A later update with new images adds to the table
+    annotations = write_result(f"{root}/by_hash", "german-women", 2, "POSSIBLE")
+    with open(f"{root}/by_hash/abc.json", "w") as f:
+        json.dump(annotations, f)
+
+    df = pd.DataFrame({"search_query": ["german women"], "position": [2], "img_sha256": ["abc"]})
+    table = vision_table.update_table(df, root, hash_dir=f"{root}/by_hash/")
+
+    assert sorted(zip(table.query_key, table.position)) == [("brazilian-women", 1), ("german-women", 2)]
+    assert list(vision_table.read_table(root).racy.astype(str).sort_values()) == ["LIKELY", "POSSIBLE"]
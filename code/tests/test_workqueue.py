@@ -0,0 +1,84 @@
+import asyncio
+
+import workqueue
+
+
+def test_circuit_breaker_opens_after_failures_in_a_row():
+
+    breaker = workqueue.CircuitBreaker(trip_after=2, cooldown=60)
+
+    breaker.failure("a")
+    assert breaker.allow("a")
+
+    breaker.failure("a")
+    assert not breaker.allow("a")
+    assert breaker.allow("b")
+
+
+def test_circuit_breaker_lets_one_request_through_after_the_cooldown():
+
+    breaker = workqueue.CircuitBreaker(trip_after=1, cooldown=0)
+    breaker.failure("a")
+
+    assert breaker.allow("a")
+
+    breaker.success("a")
+    assert "a" not in breaker.opened
+
+
+def test_success_resets_the_failure_count():
+
+    breaker = workqueue.CircuitBreaker(trip_after=2, cooldown=60)
+
+    breaker.failure("a")
+    breaker.success("a")
+    breaker.failure("a")
+
+    assert breaker.allow("a")
+
+
+def test_run_caps_the_items_of_a_host_in_flight():
+
+    items = [{"url": f"http://{host}/{n}"} for host in ("a", "b") for n in range(10)]
+    in_flight = {"a": 0, "b": 0}
+    peak = {"a": 0, "b": 0}
+    handled = [ ]
+
+    async def handle(item):
+        host = workqueue.url_host(item)
+        in_flight[host] += 1
+        peak[host] = max(peak[host], in_flight[host])
+        await asyncio.sleep(0.001)
+        in_flight[host] -= 1
+        handled.append(item)
+
+    asyncio.new_event_loop().run_until_complete(workqueue.run(items, handle, workers=8, per_host=2))
+
+    assert len(handled) == len(items)
+    assert peak == {"a": 2, "b": 2}
+
+
+def test_host_queue_takes_turns_between_hosts():
+
+    items = [{"url": "http://a/1"}, {"url": "http://a/2"}, {"url": "http://b/1"}]
+
+    async def main():
+        queue = workqueue.HostQueue(items, per_host=2)
+        return [workqueue.url_host(await queue.get()) for _ in items]
+
+    assert asyncio.new_event_loop().run_until_complete(main()) == ["a", "b", "a"]
+
+
+def test_run_processes_the_items_that_handling_queues():
+
+    items = [{"url": f"http://a/{n}"} for n in range(3)]
+    handled = [ ]
+
+    async def handle(item):
+        handled.append(item["url"])
+        if item["url"].startswith("http://a/"):
+            return [{"url": item["url"].replace("http://a/", "http://b/")}]
+
+    asyncio.new_event_loop().run_until_complete(workqueue.run(items, handle, workers=2, per_host=1))
+
+    assert sorted(handled) == [f"http://{host}/{n}" for host in ("a", "b") for n in range(3)]
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Asynchronous title fetcher used by 3.full-title-extraction.py.
+#
+# Only the <title> tag of each page is needed, so pages are streamed and fed
+# to an incremental HTML parser chunk by chunk. Reading stops as soon as the
+# title is complete, or the end of <head> is reached, or MAX_BYTES have been
+# read, whichever comes first. Like the image downloader, every page of every
+# query goes into one shared work queue, pulled by one worker per keep-alive
+# connection. The outcome of every fetch is recorded in the link contents store.
+#
+# The same page often shows up under many queries. Fetches are coalesced by
+# normalized URL, so all the search results that link to a page wait for a
+# single download of it. Pages that were fetched before are requested again
+# conditionally, and a "304 Not Modified" answer keeps the stored title.
+# Failures worth retrying are retried with backoff, and the outcome of every
+# search result is also recorded in the job ledger (see ledger.py) and the
+# run log (see runlog.py). Hosts that stop answering are skipped for a while,
+# so their pages fail at once instead of after a timeout each. As with the
+# images, the number of requests in flight adapts to the network (see
+# ratelimit.py).
+
+import asyncio
+import codecs
+import re
+import time
+from html.parser import HTMLParser
+
+import aiohttp
+
+from downloader import USER_AGENT, conditional_headers
+import ledger
+import linkstore
+from ratelimit import AsyncAdaptiveLimit
+import runlog
+import workqueue
+
+
+# Total number of simultaneous connections, and requests in flight to start with
+MAX_CONNECTIONS = 64
+INITIAL_CONNECTIONS = 16
+
+# Simultaneous connections to a single host
+MAX_CONNECTIONS_PER_HOST = 4
+
+# Seconds to wait for a server before giving up
+TIMEOUT = 10
+
+# Stop reading a page after this many bytes, even if no title was found
+MAX_BYTES = 256 * 1024
+
+CHUNK_SIZE = 8 * 1024
+
+META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+class TitleParser(HTMLParser):
+    '''
+    Incremental parser that collects the text of the first
+    <title> tag and notices when the title or the <head>
+    of the page is over.
+    '''
+
+    def __init__(self):
+
+        super().__init__(convert_charrefs=True)
+        self.in_title = False
+        self.parts = [ ]
+        self.done = False
+
+    @property
+    def title(self):
+
+        return "".join(self.parts) if self.parts else None
+
+    def handle_starttag(self, tag, attrs):
+
+        if tag == "title" and not self.done:
+            self.in_title = True
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag):
+
+        if tag == "title" and self.in_title:
+            self.in_title = False
+            self.done = True
+        elif tag == "head":
+            self.done = True
+
+    def handle_data(self, data):
+
+        if self.in_title:
+            self.parts.append(data)
+
+
+async def read_title(response):
+    '''
+    Streams the body of a response through a TitleParser
+    and returns the title, or None if there is none.
+    '''
+
+    parser = TitleParser()
+    decoder = None
+    read = 0
+
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+
+        # The encoding comes from the headers or, failing that,
+        # from a <meta charset> tag in the first chunk
+        if decoder is None:
+            charset = response.charset
+            if charset is None:
+                match = META_CHARSET.search(chunk)
+                charset = match.group(1).decode("ascii") if match else "utf-8"
+            try:
+                decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+            except LookupError:
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        parser.feed(decoder.decode(chunk))
+        read += len(chunk)
+
+        if parser.done or read >= MAX_BYTES:
+            break
+
+    return parser.title
+
+
+async def fetch_title(session, url, cached, result):
+    '''
+    Fetches the title of a page into `result`, a dictionary with the
+    final URL, the HTTP status, the title and the validators of the
+    response, which stay None if the page couldn't be reached or had
+    no title. If the page was fetched before, `cached` is its entry in
+    the URL index, and its title is kept if the page didn't change.
+    Raises ledger.JobError if the page couldn't be fetched.
+    '''
+
+    result.update(final_url=None, status=None, title=None, etag=None, last_modified=None)
+
+    try:
+        async with session.get(url, headers=conditional_headers(cached)) as r:
+
+            result.update(final_url=str(r.url), status=r.status,
+                          etag=r.headers.get("ETag"), last_modified=r.headers.get("Last-Modified"))
+
+            if r.status == 304 and cached:
+                print(f">> Not modified: {url}")
+                result.update(final_url=cached["final_url"], title=cached["title"],
+                              etag=result["etag"] or cached["etag"],
+                              last_modified=result["last_modified"] or cached["last_modified"])
+                return
+
+            if r.status >= 400:
+                print(f">> Response not succesful in {url}")
+                raise ledger.http_error(r.status)
+
+            result["title"] = await read_title(r) or None
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, UnicodeError) as e:
+        print(f"> Error {e} at url {url}")
+        raise ledger.JobError(type(e).__name__, retry=isinstance(e, (aiohttp.ClientConnectionError,
+                                                                      aiohttp.ClientPayloadError,
+                                                                      asyncio.TimeoutError)))
+
+    if not result["title"]:
+        print(f">> No titlte tag in {url}")
+
+
+async def fetch_page(session, url, breaker, limit, cached=None):
+    '''
+    Fetches the title of a page with fetch_title(), retrying the
+    failures worth retrying while `breaker` allows its host, each
+    attempt waiting for a slot of `limit`. Returns
+    the result of the last attempt, which is empty if no attempt was
+    made, the JobError it failed with, or None, the number of attempts
+    and the seconds it all took.
+    '''
+
+    result = { }
+    start = time.monotonic()
+
+    _, error, attempts = await ledger.attempt(lambda: fetch_title(session, url, cached, result),
+                                              breaker=breaker, host=workqueue.url_host({"url": url}), limit=limit)
+
+    return result, error, attempts, time.monotonic() - start
+
+
+async def download_full_title(session, conn, ledger_conn, log, breaker, limit, fetches, job):
+    '''
+    Gets the title of a single page and records it, or the
+    failure, in the link contents store, the job ledger and
+    the run log. If the page is already being fetched for
+    another search result, waits for that fetch instead of
+    starting a new one.
+
+    Params
+
+    session: an aiohttp.ClientSession
+    conn: a connection to the link contents store
+    ledger_conn: a connection to the job ledger
+    log: the run log, as returned by runlog.get()
+    breaker: the workqueue.CircuitBreaker of the hosts
+    limit: the AsyncAdaptiveLimit of the requests in flight
+    fetches: dictionary with the fetch of each normalized URL
+    job: a dictionary with the keys "search_query", "url" and "position" and,
+         if the page was fetched before, "cached", its entry in the URL index
+    '''
+
+    search_query, url, position = job["search_query"], job["url"], job["position"]
+
+    key = linkstore.url_key(url)
+
+    if key not in fetches:
+        print(f">> Fetching full title #{position} at url {url}")
+        fetches[key] = asyncio.ensure_future(fetch_page(session, url, breaker, limit, job.get("cached")))
+
+    result, error, attempts, latency = await fetches[key]
+
+    linkstore.record(conn, search_query, position, url, **result)
+    ledger.record(ledger_conn, ledger.TITLE, search_query, position, error, attempts)
+    runlog.event(log, ledger.TITLE, search_query, position, url, result.get("status"), latency, attempts, error)
+
+
+async def download_all(jobs, conn, ledger_conn, log, max_connections=MAX_CONNECTIONS,
+                       initial_connections=INITIAL_CONNECTIONS,
+                       max_connections_per_host=MAX_CONNECTIONS_PER_HOST, timeout=TIMEOUT):
+    '''
+    Fetches the titles of all the jobs through one shared, keep-alive
+    connection pool, with one worker per connection pulling from a
+    shared queue.
+
+    Params
+
+    jobs: a list of dictionaries as expected by download_full_title()
+    conn: a connection to the link contents store
+    ledger_conn: a connection to the job ledger
+    log: the run log, as returned by runlog.get()
+    max_connections: global cap on simultaneous connections, and on the requests in flight
+    initial_connections: requests in flight to start with, before the limit adapts
+    max_connections_per_host: cap on simultaneous connections to the same host
+    timeout: seconds to wait for a server to connect or send data
+    '''
+
+    connector = aiohttp.TCPConnector(limit=max_connections,
+                                     limit_per_host=max_connections_per_host)
+
+    client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=client_timeout,
+                                     headers={"User-Agent": USER_AGENT}) as session:
+
+        fetches = { }
+        breaker = workqueue.CircuitBreaker()
+        limit = AsyncAdaptiveLimit("titles", initial_connections, max_connections)
+
+        await workqueue.run(jobs, lambda job: download_full_title(session, conn, ledger_conn, log, breaker, limit,
+                                                                  fetches, job),
+                            max_connections, max_connections_per_host)
+
+    print(f"> Fetched {len(fetches)} pages for {len(jobs)} search results")
+    limit.report()
+
+
+def run(jobs, conn, ledger_conn, log, **kwargs):
+    '''
+    Synchronous entry point. Runs download_all() on the event loop.
+    '''
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(download_all(jobs, conn, ledger_conn, log, **kwargs))
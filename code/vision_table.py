@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Columnar table of Cloud Vision results.
+#
+# 5.google-vision.py saves one JSON file per search result, which is
+# convenient to inspect but slow to read back ~20,000 times. This module
+# keeps the same data in a single Parquet table with one row per search
+# result: the query, the position, the five safe search likelihoods as
+# ordered categoricals and the labels as a nested column. Step 6 joins it
+# with the search results in one go.
+#
+# Each run of the pipeline (see runs.py) has its own table and JSON files,
+# while the results stored by image hash are shared by all of them. Step 5
+# updates the table rather than replacing it, so the results of runs whose
+# images are no longer on disk, like the validation runs, are never lost.
+#
+# Running this file rebuilds the table from the JSON files already on disk:
+#
+#     python vision_table.py [--language local]
+
+import glob
+import json
+import os
+
+import pandas as pd
+
+import runs
+
+
+ROOT = "../output"
+
+TABLE_PATH = "{root}/dataset/vision-results.parquet"
+JSON_DIR = "{root}/vision_results/"
+HASH_DIR = f"{ROOT}/vision_results/by_hash/"
+
+# Names of likelihood from google.cloud.vision.enums, from least to most likely
+LIKELIHOOD_NAME = ('UNKNOWN', 'VERY_UNLIKELY', 'UNLIKELY', 'POSSIBLE',
+                   'LIKELY', 'VERY_LIKELY')
+
+SAFE_SEARCH_CATEGORIES = ["adult", "racy", "spoof", "violence", "medical"]
+
+LIKELIHOOD_DTYPE = pd.CategoricalDtype(LIKELIHOOD_NAME, ordered=True)
+
+
+def flatten(data):
+    '''
+    Turns the contents of a vision results JSON
+    file into a flat dictionary with one key per
+    likelihood and a list with the labels.
+    '''
+
+    safe_search = data["safe_search_annotations"]
+
+    row = {category: safe_search[category]["likelihood"] for category in SAFE_SEARCH_CATEGORIES}
+    row["labels"] = data["label_annotations"]
+
+    return row
+
+
+def make_table(rows):
+    '''
+    Builds the table from a list of flat dictionaries
+    with the query_key and position of each result.
+    query_key is the search query with dashes instead
+    of spaces, as used in the file names.
+    '''
+
+    table = pd.DataFrame(rows, columns=["query_key", "position"] + SAFE_SEARCH_CATEGORIES + ["labels"])
+
+    table["position"] = table["position"].astype(int)
+    for category in SAFE_SEARCH_CATEGORIES:
+        table[category] = table[category].astype(LIKELIHOOD_DTYPE)
+
+    return table
+
+
+def from_result_files(root=ROOT):
+    '''
+    Builds the table from the per search result JSON
+    files of a run, reading each of them once.
+    '''
+
+    rows = [ ]
+
+    for fpath in glob.glob(f"{JSON_DIR.format(root=root)}*.json"):
+
+        with open(fpath) as f:
+            data = json.load(f)
+
+        row = flatten(data)
+        row["query_key"] = data["search_query"]
+        row["position"] = data["position"]
+        rows.append(row)
+
+    return make_table(rows)
+
+
+def from_hash_files(df, hash_dir=HASH_DIR):
+    '''
+    Builds the table from the results stored by image hash,
+    reading each unique image's file once and repeating it
+    for every search result that returned that image.
+
+    Params
+
+    df: a dataframe with the columns search_query, position and img_sha256
+    '''
+
+    annotations = { }
+
+    for digest in df.img_sha256.dropna().unique():
+        try:
+            with open(f"{hash_dir}{digest}.json") as f:
+                annotations[digest] = flatten(json.load(f))
+        except FileNotFoundError:
+            continue
+
+    rows = [ ]
+
+    for row in df.itertuples():
+        if row.img_sha256 in annotations:
+            rows.append(dict(annotations[row.img_sha256],
+                             query_key=row.search_query.replace(" ", "-"),
+                             position=row.position))
+
+    return make_table(rows)
+
+
+def update_table(df, root=ROOT, hash_dir=HASH_DIR):
+    '''
+    Adds the results of the images in `df`, read by hash, to the
+    table of a run, along with the per search result JSON files
+    already on disk. Results that are in the table but not in `df`
+    are kept, so the table never shrinks.
+
+    Params
+
+    df: a dataframe with the columns search_query, position and img_sha256
+    root: the output directory of the run
+    hash_dir: the directory of the results stored by image hash
+    '''
+
+    tables = [from_result_files(root), from_hash_files(df, hash_dir)]
+
+    if os.path.exists(TABLE_PATH.format(root=root)):
+        tables.insert(0, read_table(root))
+
+    # The newest result of each query and position wins
+    table = pd.concat(tables, ignore_index=True)
+    table = table.drop_duplicates(subset=["query_key", "position"], keep="last")
+
+    table = make_table(table.to_dict("records"))
+    write_table(table, root)
+
+    return table
+
+
+def write_table(table, root=ROOT):
+
+    table.to_parquet(TABLE_PATH.format(root=root), index=False)
+
+
+def read_table(root=ROOT):
+    '''
+    Reads the table of a run, rebuilding it from
+    the JSON files if it doesn't exist yet.
+    '''
+
+    if not os.path.exists(TABLE_PATH.format(root=root)):
+        write_table(from_result_files(root), root)
+
+    table = pd.read_parquet(TABLE_PATH.format(root=root))
+
+    for category in SAFE_SEARCH_CATEGORIES:
+        table[category] = table[category].astype(LIKELIHOOD_DTYPE)
+
+    return table
+
+
+def main():
+
+    run = runs.parse_args("Rebuilds the table of vision results from the JSON files")
+
+    table = from_result_files(run["root"])
+    write_table(table, run["root"])
+
+    print(f"Saved {len(table)} vision results to {TABLE_PATH.format(root=run['root'])}")
+
+
+if __name__ == "__main__":
+    main()
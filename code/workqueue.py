@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Shared work queue for the asynchronous stages of the pipeline.
+#
+# A fixed number of workers, sized for the connections a stage can keep open
+# rather than for the number of CPUs, pull items one at a time from a single
+# queue until it is empty. A worker that finishes a fast item immediately
+# takes the next one, so a slow query or a slow host never leaves the other
+# workers idle while it finishes.
+#
+# Items are grouped by host, and a worker only takes an item from a host that
+# has fewer than `per_host` items in flight, taking turns between hosts. The
+# items of a popular host wait in the queue, not in a worker, so they don't
+# hold back the items of every other host.
+#
+# Handling an item can queue more items, like the thumbnail of an image
+# whose original failed, which then wait for a turn of their own host.
+#
+# A CircuitBreaker keeps track of the hosts that stopped answering. After a
+# few connection errors or timeouts in a row, the rest of the items of the
+# host fail at once instead of waiting for a timeout each, and only one of
+# them is let through now and then to check if the host is back.
+
+import asyncio
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+
+# Connection errors or timeouts in a row after which a host is skipped
+TRIP_AFTER = 5
+
+# Seconds before a skipped host is tried again
+COOLDOWN = 120
+
+
+def url_host(item):
+
+    return urlsplit(item["url"]).netloc
+
+
+class CircuitBreaker:
+    '''
+    Counts the consecutive failures of each host. A host whose
+    count reaches `trip_after` is open: allow() refuses it, except
+    for one request every `cooldown` seconds, which closes the
+    circuit again if it succeeds.
+
+    Params
+
+    trip_after: failures in a row that open the circuit of a host
+    cooldown: seconds between the requests let through to an open host
+    '''
+
+    def __init__(self, trip_after=TRIP_AFTER, cooldown=COOLDOWN):
+
+        self.trip_after = trip_after
+        self.cooldown = cooldown
+        self.failures = { }
+        self.opened = { }
+
+    def allow(self, host):
+        '''
+        Tells if a request can be sent to the host.
+        '''
+
+        if host not in self.opened:
+            return True
+
+        # Lets one request through per cooldown
+        if time.monotonic() - self.opened[host] >= self.cooldown:
+            self.opened[host] = time.monotonic()
+            return True
+
+        return False
+
+    def success(self, host):
+        '''
+        Records that the host answered, whatever the answer was.
+        '''
+
+        self.failures.pop(host, None)
+
+        if self.opened.pop(host, None) is not None:
+            print(f"> {host} is answering again")
+
+    def failure(self, host):
+        '''
+        Records that the host couldn't be reached.
+        '''
+
+        self.failures[host] = self.failures.get(host, 0) + 1
+
+        if self.failures[host] >= self.trip_after:
+            if host not in self.opened:
+                print(f"> {host} failed {self.failures[host]} times in a row, skipping it for {self.cooldown}s")
+            self.opened[host] = time.monotonic()
+
+
+class HostQueue:
+    '''
+    Hands out items so that each host has at most `per_host`
+    of them in flight, taking turns between the hosts.
+    Every item returned by get() must be given back to done(),
+    which can also add more items to the queue.
+
+    Params
+
+    items: the items to process
+    per_host: cap on the items of the same host in flight
+    host: function that returns the host of an item
+    '''
+
+    def __init__(self, items, per_host, host=url_host):
+
+        self.per_host = per_host
+        self.host = host
+
+        self.pending = { }
+        self.in_flight = { }
+        self.remaining = 0
+
+        # Items handed out and not done yet, which may still add more
+        self.busy = 0
+
+        # Hosts with pending items and a free slot, in turn
+        self.ready = deque()
+        self.is_ready = set()
+
+        for item in items:
+            self.add(item)
+
+        self.condition = asyncio.Condition()
+
+    def add(self, item):
+
+        host = self.host(item)
+
+        self.pending.setdefault(host, deque()).append(item)
+        self.in_flight.setdefault(host, 0)
+        self.remaining += 1
+
+        self.release(host)
+
+    async def get(self):
+        '''
+        Returns the next item, waiting for a host to have a free
+        slot if needed, or None once there are no items left
+        and none in flight.
+        '''
+
+        async with self.condition:
+            while not self.ready:
+                if not self.remaining and not self.busy:
+                    return None
+                await self.condition.wait()
+
+            host = self.ready.popleft()
+            self.is_ready.discard(host)
+
+            item = self.pending[host].popleft()
+            self.remaining -= 1
+            self.busy += 1
+            self.in_flight[host] += 1
+
+            # The host goes back to the end of the line
+            self.release(host)
+
+            return item
+
+    async def done(self, item, more=()):
+        '''
+        Frees the slot held by an item returned by get(),
+        and queues the items in `more`.
+        '''
+
+        async with self.condition:
+            for new_item in more:
+                self.add(new_item)
+
+            host = self.host(item)
+            self.in_flight[host] -= 1
+            self.busy -= 1
+            self.release(host)
+
+            # Waiting workers either get the slot or find the queue empty
+            self.condition.notify_all()
+
+    def release(self, host):
+
+        if self.pending[host] and self.in_flight[host] < self.per_host and host not in self.is_ready:
+            self.ready.append(host)
+            self.is_ready.add(host)
+
+
+async def run(items, handle, workers, per_host, host=url_host):
+    '''
+    Processes all the items with `workers` workers that
+    pull from one HostQueue until it is empty.
+
+    Params
+
+    items: the items to process
+    handle: coroutine function that processes one item, and
+            returns a list of more items to process, or None
+    workers: number of items in flight at the same time
+    per_host: cap on the items of the same host in flight
+    host: function that returns the host of an item
+    '''
+
+    queue = HostQueue(items, per_host, host)
+
+    async def worker():
+
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+
+            more = None
+            try:
+                more = await handle(item)
+            finally:
+                await queue.done(item, more or ())
+
+    await asyncio.gather(*[worker() for _ in range(min(workers, len(items)))])